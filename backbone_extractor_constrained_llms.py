@@ -1,10 +1,27 @@
-"""Extraction with baseline LLMs."""
+"""Constrained extraction with a llama.cpp model through guidance.
+
+The few-shot prompt is rendered once and its KV cache saved in cache/prefix/, so later runs restore it instead
+of evaluating it. The answer is constrained by the grammar of the output schema (cached in cache/grammar/,
+optionally specialised to the numbers of each report), and extract_many decodes batches of reports as
+parallel sequences of one context that share the prompt.
+"""
 
 import json
+import ctypes
+import hashlib
+import importlib.metadata
+import inspect
+import time
+import numpy as np
 import pandas as pd
 from guidance import assistant, models, gen, system, user
 import guidance
-import os, sys
+from guidance._ast import LarkNode
+from guidance._parser import TokenParser
+from collections import OrderedDict
+import os, re, sys
+import telemetry
+from postprocessing_regex import NUMBER_RE
 
 def resource_path(rel_path: str) -> str:
     base = getattr(sys, "_MEIPASS", os.path.abspath(os.path.dirname(__file__)))
@@ -20,7 +37,10 @@ def clean_value(v):
         return v
 
 def load_examples():
-    train_df = pd.read_csv(resource_path("data/examples.csv")) 
+    # No examples path: zero-shot prompt
+    if examples_path is None:
+        return []
+    train_df = pd.read_csv(examples_path) 
     fields = [c for c in train_df.columns if c != "Conclusões"]
     examples = []
     for _, row in train_df.iterrows():
@@ -30,54 +50,763 @@ def load_examples():
     return examples
 
 
-def build_lm(schema):
+def prompt_variant():
+    """Hash of what determines the few-shot prompt besides the model and the schema: the code that builds it
+    and the examples. Identifies the prompt in the extraction cache without loading the model."""
+    h = hashlib.sha256()
+    for fn in (prompt_text, load_examples, clean_value):
+        h.update(inspect.getsource(fn).encode("utf-8"))
+    if examples_path is None:
+        h.update(b"zero-shot")
+    else:
+        with open(examples_path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def model_fingerprint(path):
+    """Identify the model file by name, size and modification time (hashing a multi-GB GGUF would take longer than the prefill)."""
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def prefix_cache_path(prompt):
+    """Path of the saved prefix state for this model and few-shot prompt (system prompt, schema and examples)."""
+    key = hashlib.sha256((model_fingerprint(model_path) + "\n" + prompt).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(prefix_cache_dir, key)
+
+
+def save_prefix_state(path):
+    """Save the KV cache of the evaluated prefix (llama.cpp sequence 0), its tokens and the logits of its last token."""
+    engine = get_engine()
+    tokens = engine._cached_token_ids
+    if not tokens or engine._cached_logits is None:
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under temporary names and renamed, as the workers of a pool may save the same prefix at once.
+    # The .kv file goes last, since load_prefix_state takes it as the sign that the prefix is complete
+    tmp = f"{path}.{os.getpid()}.tmp"
+    np.save(tmp + ".logits.npy", engine._cached_logits)
+    tokens_arr = (llama_cpp.llama_token * len(tokens))(*tokens)
+    n_bytes = llama_cpp.llama_state_seq_save_file(engine.model_obj.ctx, (tmp + ".kv").encode("utf-8"), 0, tokens_arr, len(tokens))
+    if n_bytes == 0:
+        os.remove(tmp + ".logits.npy")
+        return False
+    os.replace(tmp + ".logits.npy", path + ".logits.npy")
+    os.replace(tmp + ".kv", path + ".kv")
+    return True
+
+
+def load_prefix_state(path, tokens):
+    """Restore a prefix saved by save_prefix_state into the engine, so guidance treats those tokens as already
+    evaluated. False, with the KV cache emptied, if there is none or its tokens are not tokens."""
+    if not (os.path.exists(path + ".kv") and os.path.exists(path + ".logits.npy")):
+        return False
+
+    engine = get_engine()
+    ctx = engine.model_obj.ctx
+    memory = llama_cpp.llama_get_memory(ctx)
+    llama_cpp.llama_memory_clear(memory, True)
+    engine._cached_token_ids = []
+    engine._cached_logits = None
+
+    capacity = engine.model_obj.n_ctx()
+    tokens_out = (llama_cpp.llama_token * capacity)()
+    n_tokens = ctypes.c_size_t(0)
+    n_bytes = llama_cpp.llama_state_seq_load_file(ctx, (path + ".kv").encode("utf-8"), 0, tokens_out, capacity, ctypes.byref(n_tokens))
+    if n_bytes == 0:
+        return False
+    if list(tokens_out[:n_tokens.value]) != tokens:
+        llama_cpp.llama_memory_clear(memory, True)
+        return False
+
+    engine._cached_token_ids = list(tokens)
+    engine._cached_logits = np.load(path + ".logits.npy")
+    return True
+
+
+def reset_lm():
+    """Forget the few-shot model and empty the KV cache (used to time a cold start)."""
+    global base_lm, report_budget_tokens
+    base_lm = None
+    report_budget_tokens = None
+    close_batch_context()
+    if model is None:
+        return
+    engine = get_engine()
+    engine._cached_token_ids = []
+    engine._cached_logits = None
+    llama_cpp.llama_memory_clear(llama_cpp.llama_get_memory(engine.model_obj.ctx), True)
+
+
+def get_model():
+    """The model, loaded with the current settings (see configure) the first time it is needed."""
+    global model, llama_cpp
+    if model is None:
+        import llama_cpp
+        t0 = time.perf_counter()
+        model = models.LlamaCpp(model_path, n_gpu_layers=N_GPU_LAYERS, n_ctx=N_CTX, n_threads=N_THREADS,
+                                n_batch=N_BATCH)
+        print(f"Model {os.path.basename(model_path)} loaded in {time.perf_counter() - t0:.2f}s.")
+    return model
+
+
+def get_engine():
+    return get_model()._interpreter.engine
+
+
+def configure(model_path=None, quantization=None, n_threads=None, n_ctx=None, n_batch=None, n_gpu_layers=None):
+    """Change the model settings. quantization picks the GGUF file of MODEL_NAME in base_path
+    (e.g. Q4_K_M -> models/gpt-oss-20b-Q4_K_M.gguf) when no model_path is given.
+    A loaded model is unloaded if the settings change, and the next extraction loads the new one."""
+    global QUANTIZATION, N_THREADS, N_CTX, N_BATCH, N_GPU_LAYERS, model
+    previous = settings()
+    if quantization is not None:
+        QUANTIZATION = quantization
+        globals()["model_path"] = model_file(MODEL_NAME, QUANTIZATION)
+    if model_path is not None:
+        globals()["model_path"] = model_path
+    N_THREADS = n_threads if n_threads is not None else N_THREADS
+    N_CTX = n_ctx if n_ctx is not None else N_CTX
+    N_BATCH = n_batch if n_batch is not None else N_BATCH
+    N_GPU_LAYERS = n_gpu_layers if n_gpu_layers is not None else N_GPU_LAYERS
+    if settings() != previous:
+        reset_lm()
+        model = None
+
+
+def settings():
+    """Current model settings, as keyword arguments of configure."""
+    return {"model_path": model_path, "n_threads": N_THREADS, "n_ctx": N_CTX, "n_batch": N_BATCH,
+            "n_gpu_layers": N_GPU_LAYERS}
+
+
+def set_model(path):
+    """Use another GGUF model and forget the few-shot model built with the previous one."""
+    configure(model_path=path)
+
+
+def model_file(name, quantization):
+    return os.path.join(base_path, f'{name}-{quantization}.gguf')
+
+
+def set_specialise(on):
+    """Constrain the FFR/iFR fields to the candidate values of each report (True) or use the static schema."""
+    global SPECIALISE_SCHEMA
+    SPECIALISE_SCHEMA = bool(on)
+
+
+def set_examples(path):
+    """Use the few-shot examples of another file (None for zero-shot)."""
+    global examples_path
+    if path != examples_path:
+        examples_path = path
+        reset_lm()
+
+
+def build_lm(schema, use_prefix_cache=True):
+    """The model with the few-shot prompt in its context. The prompt is rendered as text and its KV cache
+    restored from the saved prefix when the saved tokens are the same; it is only evaluated on a miss."""
     global base_lm
     if base_lm is not None:
         return base_lm.copy()
 
-    with user(): #system for all the models except mistral, user
-        descriptions = []
+    t0 = time.perf_counter()
+    text = prompt_text(schema)
+    tokens = prefix_tokens(text)
+    cache_path = prefix_cache_path(text)
+    if use_prefix_cache and load_prefix_state(cache_path, tokens):
+        print(f"Few-shot model restored from {cache_path} in {time.perf_counter() - t0:.2f}s.")
+    else:
+        get_engine().get_logits(tokens)
+        if use_prefix_cache:
+            save_prefix_state(cache_path)
+        print(f"Few-shot model initialized in {time.perf_counter() - t0:.2f}s.")
+
+    # guidance continues from the rendered text; the engine finds its tokens already evaluated
+    base_lm = get_model().copy()
+    base_lm._interpreter.state.prompt = text
+    return base_lm.copy()
+
 
-        for field, props in schema["properties"].items():
-            desc = props.get("description", "")
-            if "enum" in props:
-                enum_vals = ", ".join(f'"{v}"' for v in props["enum"])
-                desc = f"{desc} (possible values: {enum_vals})"
-            descriptions.append(f"{field}: {desc}")
+def chat_turn(role, text):
+    """A message of the conversation as the chat template of the model renders it."""
+    interpreter = get_model()._interpreter
+    return interpreter.get_role_start(role) + text + interpreter.get_role_end(role)
 
-        base_lm = (
-            model
-            + "És um especialista em relatórios de angiografias/coronariografia e angioplastia. O relatório inclui informação relativa aos indices de fisiologia: fractional flow reserve ou FFR e instant wave-free ratio ou iFR."
-            "Dá como output um JSON válido. Usa estas descrições como referência:\n\n"
-            + "\n".join(descriptions)
-        )
 
+def prompt_text(schema):
+    """The few-shot prompt: instructions and field descriptions, then a user and an assistant turn per example."""
+    descriptions = []
+    for field, props in schema["properties"].items():
+        desc = props.get("description", "")
+        if "enum" in props:
+            enum_vals = ", ".join(f'"{v}"' for v in props["enum"])
+            desc = f"{desc} (possible values: {enum_vals})"
+        descriptions.append(f"{field}: {desc}")
+
+    text = chat_turn("user", #system for all the models except mistral, user
+        "És um especialista em relatórios de angiografias/coronariografia e angioplastia. O relatório inclui informação relativa aos indices de fisiologia: fractional flow reserve ou FFR e instant wave-free ratio ou iFR."
+        "Dá como output um JSON válido. Usa estas descrições como referência:\n\n"
+        + "\n".join(descriptions)
+    )
     for ex in load_examples():
-        with user():
-            base_lm = base_lm + ex["prompt"]
-        with assistant():
-            base_lm = base_lm + ex["reply"]
+        text += chat_turn("user", ex["prompt"]) + chat_turn("assistant", ex["reply"])
+    return text
 
-    print("Few-shot model initialized.")
-    return base_lm.copy()
 
+def prefix_tokens(text):
+    """Tokens of text at the start of the context, with the BOS token guidance adds before them."""
+    tokenizer = get_engine().tokenizer
+    tokens = tokenizer.encode(text.encode("utf-8"))
+    if tokenizer.bos_token_id is not None and tokens[:1] != [tokenizer.bos_token_id]:
+        tokens = [tokenizer.bos_token_id] + tokens
+    return tokens
 
-def extract(input):
-    
-    schema_path = resource_path("output_schema_copied.json")
-    schema = json.load(open(schema_path, "r"))
 
+def load_schema(path=None):
+    """Load the output schema and its content hash. The file is only re-read when its size or mtime change."""
+    path = path or schema_path
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = schema_cache.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, "rb") as f:
+            raw = f.read()
+        cached = (stamp, json.loads(raw), hashlib.sha256(raw).hexdigest())
+        schema_cache[path] = cached
+    return cached[1], cached[2]
+
+
+def constraint_schema(schema):
+    """Drop the annotations the grammar does not use (descriptions go in the prompt, not in the constraint)."""
+    if isinstance(schema, list):
+        return [constraint_schema(s) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    out = {}
+    for key, value in schema.items():
+        if key in ("description", "title", "$schema"):
+            continue
+        if key == "properties":
+            out[key] = {name: constraint_schema(prop) for name, prop in value.items()}
+        else:
+            out[key] = constraint_schema(value)
+    return out
+
+
+def grammar_file(digest):
+    """File of the compiled grammar of a schema in cache/grammar/. The grammar guidance serializes depends on
+    the guidance and llguidance versions, so they are part of its name."""
+    versions = f"guidance {guidance.__version__}, llguidance {importlib.metadata.version('llguidance')}"
+    key = hashlib.sha256(f"{digest}\n{versions}".encode("utf-8")).hexdigest()
+    return os.path.join(grammar_cache_dir, f"{key}.lark")
+
+
+def schema_grammar(schema, digest):
+    """Compiled constraint grammar for a schema, cached in memory by schema hash and in cache/grammar/ by schema
+    hash and guidance/llguidance versions."""
+    grammar = grammar_cache.get(digest)
+    if grammar is not None:
+        return grammar
+
+    path = grammar_file(digest)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            lark_grammar = f.read()
+    else:
+        # guidance.json validates the schema with llguidance before serializing it
+        lark_grammar = guidance.json(schema=constraint_schema(schema), name="res").ll_grammar()
+        os.makedirs(grammar_cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(lark_grammar)
+        os.replace(tmp_path, path)
+
+    grammar = LarkNode(lark_grammar=lark_grammar)
+    grammar_cache[digest] = grammar
+    return grammar
+
+
+def value_candidates(text):
+    """Numbers written with a decimal part in a report that are plausible FFR/iFR values, sorted.
+    Integers in the range (0, 1, counts of stents or vessels) are never FFR/iFR values."""
+    low, high = PLAUSIBLE_RANGE
+    values = set()
+    for number in NUMBER_RE.findall(str(text)):
+        number = number.replace(',', '.')
+        if number.partition('.')[2] and low <= float(number) <= high:
+            values.add(float(number))
+    return tuple(sorted(values))
+
+
+def report_schema(schema, candidates):
+    """schema with each FFR/iFR field restricted to one of the candidates or null. Without candidates the
+    fields can only be null, so the grammar forces them and they are not sampled. As every value is then
+    written in the report and plausible, the RegEx confirmation and the implausible filter have nothing to remove."""
+    properties = {}
+    for field, props in schema["properties"].items():
+        if "number" in props.get("type", []):
+            props = {"enum": list(candidates) + [None]} if candidates else {"type": "null"}
+        properties[field] = props
+    return {**schema, "properties": properties}
+
+
+def report_grammar(schema, digest, text):
+    """Constraint grammar for a report: the grammar of report_schema when SPECIALISE_SCHEMA is set, kept in an
+    LRU cache by schema hash and candidates, else the grammar of the static schema."""
+    if not SPECIALISE_SCHEMA:
+        return schema_grammar(schema, digest)
+    key = (digest, value_candidates(text))
+    grammar = specialised_cache.get(key)
+    if grammar is not None:
+        specialised_cache.move_to_end(key)
+        return grammar
+
+    # Least recently used grammars go first when the cache is full
+    if len(specialised_cache) >= SPECIALISED_CACHE_SIZE:
+        specialised_cache.popitem(last=False)
+    schema = constraint_schema(report_schema(schema, key[1]))
+    grammar = LarkNode(lark_grammar=guidance.json(schema=schema, name="res").ll_grammar())
+    specialised_cache[key] = grammar
+    return grammar
+
+
+def count_tokens(text):
+    return len(get_engine().tokenizer.encode(text.encode("utf-8")))
+
+
+def report_budget(schema):
+    """Tokens left for the report once the few-shot prompt and the answer are in the context."""
+    global report_budget_tokens
+    if report_budget_tokens is None:
+        # The chat markers of the rendered prompt are counted as text, which overestimates the prompt a little
+        prompt_tokens = count_tokens(str(build_lm(schema)))
+        report_budget_tokens = N_CTX - prompt_tokens - ANSWER_TOKENS
+        if report_budget_tokens <= CHUNK_OVERLAP:
+            raise ValueError(f"The few-shot prompt ({prompt_tokens} tokens) leaves no room for the report in n_ctx={N_CTX}")
+    return report_budget_tokens
+
+
+def split_report(report, budget, overlap):
+    """Split a report into windows of whole sentences of at most budget tokens.
+    Each window repeats the last sentences of the previous one, up to overlap tokens."""
+    pieces = []
+    for sentence in re.split(r'(?<=[.;])\s+|\n+', report):
+        if not sentence.strip():
+            continue
+        n = count_tokens(sentence)
+        if n <= budget:
+            pieces.append((sentence, n))
+            continue
+        # A sentence longer than a window is cut at token boundaries
+        tokens = get_engine().tokenizer.encode(sentence.encode("utf-8"))
+        for start in range(0, len(tokens), budget - overlap):
+            part = get_engine().tokenizer.decode(tokens[start:start + budget])
+            pieces.append((part.decode("utf-8", errors="ignore"), len(tokens[start:start + budget])))
+
+    windows, current, current_tokens = [], [], 0
+    for piece, n in pieces:
+        if current and current_tokens + n > budget:
+            windows.append(" ".join(p for p, _ in current))
+            carry, carry_tokens = [], 0
+            for p, pn in reversed(current):
+                if carry_tokens + pn > overlap or carry_tokens + pn + n > budget:
+                    break
+                carry.insert(0, (p, pn))
+                carry_tokens += pn
+            current, current_tokens = carry, carry_tokens
+        current.append((piece, n))
+        current_tokens += n
+    if current:
+        windows.append(" ".join(p for p, _ in current))
+    return windows
+
+
+def merge_extractions(results, schema):
+    """Merge the extractions of the windows of a report: the lowest value per artery (as the prompt asks
+    when there is more than one measurement), angioplastia if any window found it, otherwise the first value."""
+    parsed = []
+    for res in results:
+        try:
+            parsed.append(json.loads(res))
+        except (TypeError, json.JSONDecodeError):
+            continue
+    if not parsed:
+        return None
+
+    merged = {}
+    for field, props in schema["properties"].items():
+        values = [p.get(field) for p in parsed if p.get(field) is not None]
+        if "number" in props.get("type", []):
+            numbers = [v for v in values if isinstance(v, (int, float))]
+            merged[field] = min(numbers) if numbers else None
+        elif field == "Tipo" and "Coronariografia e Angioplastia" in values:
+            merged[field] = "Coronariografia e Angioplastia"
+        else:
+            merged[field] = values[0] if values else None
+    return json.dumps(merged, ensure_ascii=False)
+
+
+def extract_window(schema, digest, input):
     lm = build_lm(schema)
 
     with user():
         lm += input
     with assistant():
-        lm += guidance.json(schema=schema, name="res")
+        lm += report_grammar(schema, digest, input)
 
     return lm["res"]
 
 
+def extract(input):
+
+    schema, digest = load_schema()
+
+    # Reports that fit in the context are extracted directly (a token is at least one byte,
+    # so short reports are not even tokenized)
+    budget = report_budget(schema)
+    if len(input.encode("utf-8")) <= budget or count_tokens(input) <= budget:
+        return extract_window(schema, digest, input)
+
+    # Longer reports are extracted in overlapping windows and the results merged
+    windows = split_report(input, budget, CHUNK_OVERLAP)
+    return merge_extractions([extract_window(schema, digest, w) for w in windows], schema)
+
+
+def safe_extract(input):
+    """extract(), or None if the extraction of the report fails."""
+    try:
+        return extract(input)
+    except Exception:
+        return None
+
+
+def extract_timed(input):
+    """extract() with the telemetry of the report, from the llama.cpp performance counters of the context."""
+    # Build the few-shot prefix first, so its evaluation is not counted in the report
+    build_lm(load_schema()[0])
+    ctx = get_engine().model_obj.ctx
+    llama_cpp.llama_perf_context_reset(ctx)
+    t0 = time.perf_counter()
+    result = extract(input)
+    latency_ms = (time.perf_counter() - t0) * 1000
+    return result, telemetry.from_llama_cpp(llama_cpp.llama_perf_context(ctx), latency_ms)
+
+
+def common_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class BatchContext:
+    """llama.cpp context on the weights of the model with one sequence per report of a batch.
+    Sequence 0 holds the common prefix of the batch (the few-shot prompt), evaluated once; the other
+    sequences start from its KV cells instead of evaluating it again."""
+
+    def __init__(self, n_seq, n_ctx):
+        llama = get_engine().model_obj
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_seq_max = n_seq + 1
+        # The threads of the model context (llama.cpp would use 4, even on fewer cores)
+        params.n_threads = N_THREADS or llama.context_params.n_threads
+        params.n_threads_batch = N_THREADS or llama.context_params.n_threads_batch
+        # A single KV buffer for all the sequences, so copying the prefix shares its cells
+        if hasattr(params, "kv_unified"):
+            params.kv_unified = True
+        # The KV layout of the model context, so the prefix it saved can be loaded (see load_prefix)
+        for name in ("flash_attn_type", "flash_attn", "type_k", "type_v"):
+            if hasattr(params, name):
+                setattr(params, name, getattr(llama.context_params, name))
+        self.ctx = llama_cpp.llama_init_from_model(llama.model, params)
+        if not self.ctx:
+            raise RuntimeError(f"Could not create a llama.cpp context with {n_seq} sequences of n_ctx={n_ctx}")
+        self.n_seq = n_seq
+        self.memory = llama_cpp.llama_get_memory(self.ctx)
+        self.n_batch = llama_cpp.llama_n_batch(self.ctx)
+        self.n_vocab = llama_cpp.llama_vocab_n_tokens(llama_cpp.llama_model_get_vocab(llama.model))
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+        # Tokens in the KV cache of each sequence
+        self.kv = [[] for _ in range(n_seq + 1)]
+
+    def truncate(self, seq, n):
+        if n < len(self.kv[seq]):
+            llama_cpp.llama_memory_seq_rm(self.memory, seq, n, -1)
+            self.kv[seq] = self.kv[seq][:n]
+
+    def load_prefix(self, path, tokens):
+        """Start sequence 0 from the prefix saved by save_prefix_state when it is empty and the saved tokens are
+        tokens, instead of evaluating them again."""
+        if self.kv[0] or not os.path.exists(path + ".kv"):
+            return False
+        tokens_out = (llama_cpp.llama_token * len(tokens))()
+        n_tokens = ctypes.c_size_t(0)
+        n_bytes = llama_cpp.llama_state_seq_load_file(self.ctx, (path + ".kv").encode("utf-8"), 0, tokens_out,
+                                                      len(tokens), ctypes.byref(n_tokens))
+        if n_bytes == 0 or list(tokens_out[:n_tokens.value]) != tokens:
+            llama_cpp.llama_memory_seq_rm(self.memory, 0, -1, -1)
+            return False
+        self.kv[0] = list(tokens)
+        return True
+
+    def set_prefix(self, tokens):
+        """Evaluate the common prefix in sequence 0, keeping what is already there from the previous batch."""
+        self.truncate(0, common_prefix_length(tokens, self.kv[0]))
+        self.decode({0: tokens}, logits=False)
+
+    def fork(self, seq, tokens):
+        """Start a sequence from the part of the prefix its tokens share."""
+        n = common_prefix_length(tokens, self.kv[0])
+        llama_cpp.llama_memory_seq_rm(self.memory, seq, -1, -1)
+        llama_cpp.llama_memory_seq_cp(self.memory, 0, seq, 0, n)
+        self.kv[seq] = self.kv[0][:n]
+
+    def decode(self, requests, logits=True):
+        """Bring the KV cache of each sequence up to its tokens ({seq: tokens}) in as few llama_decode calls as
+        possible, and return the logits of the last token of each sequence."""
+        entries = []
+        for seq, tokens in requests.items():
+            n = common_prefix_length(tokens, self.kv[seq])
+            if logits and n == len(tokens):
+                n -= 1  # the logits of the last token are needed again
+            self.truncate(seq, n)
+            entries += [(seq, n + j, token, logits and n + j == len(tokens) - 1) for j, token in enumerate(tokens[n:])]
+            self.kv[seq] = list(tokens)
+
+        out = {}
+        for start in range(0, len(entries), self.n_batch):
+            chunk = entries[start:start + self.n_batch]
+            for j, (seq, pos, token, output) in enumerate(chunk):
+                self.batch.token[j] = token
+                self.batch.pos[j] = pos
+                self.batch.n_seq_id[j] = 1
+                self.batch.seq_id[j][0] = seq
+                self.batch.logits[j] = output
+            self.batch.n_tokens = len(chunk)
+            if llama_cpp.llama_decode(self.ctx, self.batch) != 0:
+                raise RuntimeError("llama_decode failed (KV cache full?)")
+            for j, (seq, _, _, output) in enumerate(chunk):
+                if output:
+                    ptr = llama_cpp.llama_get_logits_ith(self.ctx, j)
+                    out[seq] = np.ctypeslib.as_array(ptr, shape=(self.n_vocab,)).copy()
+        return out
+
+    def close(self):
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+
+def batch_context(n_seq):
+    """The batch context, created on first use and kept for the next batches (and their shared prefix)."""
+    global batch_ctx
+    if batch_ctx is None or batch_ctx.n_seq < n_seq:
+        close_batch_context()
+        # Each sequence fits in N_CTX, and the prefix they share is only stored once
+        batch_ctx = BatchContext(n_seq, N_CTX * n_seq)
+    return batch_ctx
+
+
+def close_batch_context():
+    global batch_ctx
+    if batch_ctx is not None:
+        batch_ctx.close()
+        batch_ctx = None
+
+
+def report_prompt(base, report):
+    """Text before the answer of a report: few-shot prompt, report and start of the assistant turn, as guidance
+    renders it for extract(). It is built as text, so only the batch context evaluates the report."""
+    return str(base) + chat_turn("user", report) + get_model()._interpreter.get_role_start("assistant")
+
+
+def decode_batch(ctx, prompts, grammars):
+    """Decode the answers of the prompts as parallel sequences of ctx, each constrained by its own parser
+    of its grammar, in the same way as the guidance engine does for one prompt."""
+    engine = get_engine()
+    tokenizer = engine.tokenizer
+    seqs = []
+    for prompt, grammar in zip(prompts, grammars):
+        parser = TokenParser(grammar, tokenizer=tokenizer, enable_backtrack=engine.enable_backtrack,
+                             enable_ff_tokens=engine.enable_ff_tokens)
+        tokens = tokenizer.encode(prompt.encode("utf-8"))
+        prefix_tokens, backtrack, ff_tokens, mask_fut = parser.process_prompt(prompt_tokens=tokens, ensure_bos_token=True)
+        tokens = prefix_tokens + tokens
+        if backtrack:
+            tokens = tokens[:-backtrack]
+        tokens += ff_tokens
+        if prefix_tokens:
+            tokens = tokenizer.recode(tokens)
+        seqs.append({"parser": parser, "tokens": tokens, "mask_fut": mask_fut, "captures": {}})
+
+    prefix = seqs[0]["tokens"]
+    for seq in seqs[1:]:
+        prefix = prefix[:common_prefix_length(prefix, seq["tokens"])]
+    ctx.set_prefix(prefix)
+    for i, seq in enumerate(seqs, start=1):
+        ctx.fork(i, seq["tokens"])
+
+    active = list(range(len(seqs)))
+    while active:
+        # One llama_decode for the new tokens of every sequence that is not about to stop
+        logits = ctx.decode({i + 1: seqs[i]["tokens"] for i in active if not seqs[i]["parser"].has_pending_stop()})
+        still_active = []
+        for i in active:
+            seq = seqs[i]
+            parser = seq["parser"]
+            try:
+                mask, ll_response, _ = seq["mask_fut"].result()
+                seq["captures"].update(ll_response.progress.to_engine_call_response().capture_groups)
+                if ll_response.stop:
+                    parser.cleanup()
+                    continue
+
+                # Same sampling as the engine: once the answer can end, an illegal token ends it
+                can_finish_early = parser.is_accepting() and tokenizer.eos_token_id is not None
+                token_id = engine.get_next_token_with_top_k(
+                    logits=logits[i + 1], logits_lat_ms=0.0, token_ids=seq["tokens"],
+                    mask=None if can_finish_early else mask, temperature=ll_response.temperature, k=0,
+                    compute_unmasked_probs=False, sampling_params=None).token_id
+                if can_finish_early and not mask[token_id]:
+                    token_id = tokenizer.eos_token_id
+
+                backtrack, ff_tokens, seq["mask_fut"] = parser.advance(token_id=token_id)
+            except Exception:
+                # Only this report fails, as extract() would
+                seq["captures"] = {}
+                continue
+            if backtrack:
+                seq["tokens"] = seq["tokens"][:-backtrack]
+            seq["tokens"] = seq["tokens"] + ff_tokens
+            still_active.append(i)
+        active = still_active
+
+    results = []
+    for seq in seqs:
+        value = seq["captures"].get("res")
+        results.append(value.decode("utf-8") if isinstance(value, bytes) else None)
+    return results
+
+
+def extract_many(reports, batch_size=None):
+    """Extract several reports, batch_size at a time as parallel sequences of one llama.cpp context that share
+    the few-shot prefix. Returns the extractions in the order of the reports (None if one fails).
+    Reports too long for the context are extracted one by one, in windows, by extract()."""
+    batch_size = batch_size or BATCH_SIZE
+    schema, digest = load_schema()
+    base = build_lm(schema)
+    budget = report_budget(schema)
+
+    results = [None] * len(reports)
+    batched = []
+    for i, report in enumerate(reports):
+        report = str(report)
+        if len(report.encode("utf-8")) <= budget or count_tokens(report) <= budget:
+            batched.append(i)
+        else:
+            results[i] = safe_extract(report)
+
+    if batched:
+        ctx = batch_context(min(batch_size, len(batched)))
+        text = str(base)
+        ctx.load_prefix(prefix_cache_path(text), prefix_tokens(text))
+        for start in range(0, len(batched), batch_size):
+            indices = batched[start:start + batch_size]
+            try:
+                prompts = [report_prompt(base, str(reports[i])) for i in indices]
+                grammars = [report_grammar(schema, digest, str(reports[i])).ll_grammar() for i in indices]
+                batch_results = decode_batch(ctx, prompts, grammars)
+            except Exception:
+                # A failed llama_decode loses the whole batch: its reports are extracted one by one instead
+                batch_results = [safe_extract(str(reports[i])) for i in indices]
+            for i, result in zip(indices, batch_results):
+                results[i] = result
+    return results
+
+
+def time_to_first_extraction(report, schema, use_prefix_cache):
+    """Seconds from an empty context to the first extracted report."""
+    reset_lm()
+    t0 = time.perf_counter()
+    build_lm(schema, use_prefix_cache=use_prefix_cache)
+    extract(report)
+    return time.perf_counter() - t0
+
+
+# Model settings (see configure). The model is only loaded when first needed, so importing this module is cheap
 base_path = resource_path('models')
-model_path = os.path.join(base_path, 'gpt-oss-20b-F16.gguf')
-model = models.LlamaCpp(model_path, n_gpu_layers=-1, n_ctx=4096)
-base_lm = None
\ No newline at end of file
+MODEL_NAME = 'gpt-oss-20b'
+QUANTIZATION = 'F16'
+model_path = model_file(MODEL_NAME, QUANTIZATION)
+N_CTX = 4096
+N_BATCH = 512
+N_GPU_LAYERS = -1
+# Threads of llama.cpp (None: its default). The worker pool sets LLAMA_N_THREADS so its processes share the cores
+N_THREADS = int(os.environ.get("LLAMA_N_THREADS", 0)) or None
+# Tokens kept free for the JSON answer, and repeated between consecutive windows of a long report
+ANSWER_TOKENS = 256
+CHUNK_OVERLAP = 64
+# Reports decoded in parallel by extract_many
+BATCH_SIZE = 8
+# Constrain the FFR/iFR fields of each report to the numbers written in it (see report_schema)
+SPECIALISE_SCHEMA = False
+# Values outside this range are never candidates (the range of postprocessing_implausible)
+PLAUSIBLE_RANGE = (0.0, 1.1)
+# Grammars of specialised schemas kept in memory
+SPECIALISED_CACHE_SIZE = 1024
+model = None
+llama_cpp = None
+base_lm = None
+report_budget_tokens = None
+examples_path = resource_path('data/examples.csv')
+prefix_cache_dir = resource_path('cache/prefix')
+schema_path = resource_path('output_schema.json')
+schema_cache = {}
+grammar_cache_dir = resource_path('cache/grammar')
+grammar_cache = {}
+specialised_cache = OrderedDict()
+batch_ctx = None
+
+
+if __name__ == "__main__":
+    # Time to first extraction with and without the saved few-shot prefix
+    schema, _ = load_schema()
+    report = pd.read_csv(resource_path("data/examples.csv"))["Conclusões"].iloc[0]
+    print(f"Without prefix cache: {time_to_first_extraction(report, schema, use_prefix_cache=False):.2f}s")
+    time_to_first_extraction(report, schema, use_prefix_cache=True)  # makes sure the prefix is saved
+    print(f"With restored prefix: {time_to_first_extraction(report, schema, use_prefix_cache=True):.2f}s")
+
+    # Per-report schema/grammar overhead: re-reading the schema and rebuilding guidance.json vs the cache
+    n = 200
+    t0 = time.perf_counter()
+    for _ in range(n):
+        guidance.json(schema=json.load(open(schema_path, "r")), name="res").ll_grammar()
+    t1 = time.perf_counter()
+    for _ in range(n):
+        schema_grammar(*load_schema()).ll_grammar()
+    t2 = time.perf_counter()
+    print(f"Schema/grammar overhead per report: {(t1 - t0) / n * 1000:.3f}ms uncached, {(t2 - t1) / n * 1000:.3f}ms cached")
+    # Throughput of the sequential loop of extractor_constrained_llms vs extract_many
+    reports = pd.read_csv(resource_path("data/reports_groundtruth.csv"))["Conclusões"].astype(str).head(4 * BATCH_SIZE).tolist()
+    t0 = time.perf_counter()
+    sequential = [extract(r) for r in reports]
+    t1 = time.perf_counter()
+    batched = extract_many(reports, BATCH_SIZE)
+    t2 = time.perf_counter()
+    same = sum(a == b for a, b in zip(sequential, batched))
+    print(f"Sequential: {len(reports) / (t1 - t0):.2f} reports/s, batches of {BATCH_SIZE}: {len(reports) / (t2 - t1):.2f} reports/s "
+          f"({(t1 - t0) / (t2 - t1):.1f}x), {same}/{len(reports)} identical extractions")
+
+    # Generated tokens and latency per report with the static schema vs the schema specialised to each report
+    for on in (False, True):
+        set_specialise(on)
+        timings = [extract_timed(r)[1] for r in reports]
+        tokens = np.mean([t["generated_tokens"] for t in timings])
+        latency = np.mean([t["latency_ms"] for t in timings])
+        print(f"{'Specialised' if on else 'Static'} schema: {tokens:.1f} generated tokens/report, {latency:.0f}ms/report")
+    set_specialise(False)
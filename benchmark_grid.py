@@ -0,0 +1,215 @@
+"""Run every model/prompt combination of a config file and build the results table.
+
+Each cell of the grid runs the extraction of its method (baseline LLM or constrained LLM), the postprocessing
+chain (formatting, removal of implausible values for the implausible prompt, optional RegEx confirmation) and
+the evaluation against the ground truth. The metrics are written to metrics.csv with the wall time, reports/s
+and tokens/s of the extraction, and the LaTeX table in the format of results/results.tex.
+
+Models with "backend": "stub" answer with the regex baseline values, so the whole grid runs offline.
+Tokens are counted as words and punctuation (prefilter.approx_tokens), the same for every backend.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+import pandas as pd
+from tqdm import tqdm
+import extractor_baseline_llms as baseline_llms
+from evaluation import evaluate_FFR_iFR
+from extractor_baseline_regex import remove_accents, run_extraction, vessel_measures, measure_keywords, \
+    vessel_keywords, MAX_WORD_DISTANCE, default_measure
+from postprocessing_constrained import format_extractions
+from postprocessing_implausible import remove_implausible
+from postprocessing_regex import confirm_values, ffr_ifr_cols
+from prefilter import approx_tokens, procedure_type
+from storage import write_table
+
+# Few-shot examples of the constrained extractor for each prompt
+constrained_examples = {
+    "zero_shot": None,
+    "one_shot": "data/examples.csv",
+    "one_shot_absurd": "data/examples_implausible.csv",
+}
+
+
+def stub_values(report):
+    """FFR/iFR values found by the regex baseline, used as the answer of the stub model."""
+    found = vessel_measures(remove_accents(str(report)), measure_keywords, vessel_keywords, MAX_WORD_DISTANCE,
+                            default_measure)
+    return {col: found.get(col) for col in ffr_ifr_cols}
+
+
+def stub_answer(method, report):
+    values = stub_values(report)
+    if method == "constrained":
+        return json.dumps({"Tipo": procedure_type(report), **values}, ensure_ascii=False)
+    return json.dumps({artery: {"FFR": values[f"{artery.replace(' ', '_')}_FFR"],
+                                "iFR": values[f"{artery.replace(' ', '_')}_iFR"]}
+                       for artery in baseline_llms.ARTERIES}, ensure_ascii=False)
+
+
+def make_extractor(method, model_cfg, prompt):
+    """Function report -> raw answer for a cell of the grid."""
+    backend = model_cfg["backend"]
+    if backend == "stub":
+        return lambda report: stub_answer(method, report)
+
+    if method == "baseline":
+        make_llm = baseline_llms.make_chat_llm if model_cfg.get("prefix_prompts") else baseline_llms.make_llm
+        llm = make_llm(model_cfg["ollama_model"], model_cfg.get("base_url"))
+        return lambda report: baseline_llms.extract_FFR_iFR(report, llm, prompt)
+
+    # guidance is only imported when a constrained cell runs
+    import backbone_extractor_constrained_llms as extractor
+    if os.path.abspath(model_cfg["gguf"]) != os.path.abspath(extractor.model_path):
+        extractor.set_model(model_cfg["gguf"])
+    extractor.set_examples(constrained_examples[prompt] and extractor.resource_path(constrained_examples[prompt]))
+    return lambda report: extractor.extract(str(report))
+
+
+def prompt_tokens(method, prompt, report):
+    # The constrained few-shot prefix is evaluated once and reused, so only the report counts
+    if method == "baseline":
+        return approx_tokens(baseline_llms.question_FFR_iFR(report, prompt))
+    return approx_tokens(report)
+
+
+def run_extraction_cell(method, model_cfg, prompt, reports):
+    """Raw answers of a cell and the timing of the extraction."""
+    extract = make_extractor(method, model_cfg, prompt)
+    answers, tokens = [], 0
+    t0 = time.perf_counter()
+    for report in tqdm(reports, desc=f"{model_cfg['label']} {method} {prompt}"):
+        try:
+            answer = extract(report)
+        except Exception as e:
+            print(f"Extraction failed: {e!r}")
+            answer = None
+        answers.append(answer)
+        tokens += prompt_tokens(method, prompt, report) + approx_tokens(answer or "")
+    elapsed = time.perf_counter() - t0
+    return answers, {"wall_time_s": elapsed, "reports_per_s": len(reports) / elapsed, "tokens_per_s": tokens / elapsed}
+
+
+def predictions(method, prompt, answers, df_true):
+    """Postprocessed FFR/iFR table of a cell, in the same row order as the ground truth."""
+    if method == "baseline":
+        # format_FFR_iFR prints every answer
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = [baseline_llms.format_FFR_iFR(baseline_llms.clean_results_JSON(a or "")) for a in answers]
+        df = pd.DataFrame(rows)
+    else:
+        ids = df_true["id"] if "id" in df_true.columns else range(len(df_true))
+        df = format_extractions(pd.DataFrame({"id": ids, "Conclusões": df_true["Conclusões"], "extracted": answers}))
+    df = df.reindex(columns=ffr_ifr_cols)
+    df.insert(0, "Conclusões", df_true["Conclusões"].values)
+
+    if prompt == "one_shot_absurd":
+        df = remove_implausible(df)
+    return df
+
+
+def row_label(model_cfg, prompt_label, method, confirmed):
+    label = f"{model_cfg['label']} {prompt_label}"
+    if method == "constrained":
+        label += " Constrained"
+    if confirmed:
+        label += " + RegEx"
+    return label
+
+
+def run_grid(config):
+    output_dir = config["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    df_true = pd.read_csv(config["reports"])
+    if config.get("limit"):
+        df_true = df_true.head(config["limit"])
+    reports = df_true["Conclusões"].tolist()
+
+    rows = []
+    if config.get("regex_baseline", True):
+        t0 = time.perf_counter()
+        df_pred = run_extraction(df_true.reset_index(drop=True))
+        elapsed = time.perf_counter() - t0
+        metrics = evaluate_FFR_iFR(df_true, df_pred, verbose=False)
+        tokens = sum(approx_tokens(r) for r in reports)
+        rows.append({"section": None, "label": "Baseline RegEx", "method": "regex", "model": "regex", "prompt": None,
+                     "regex_confirmation": False, **metrics, "wall_time_s": elapsed,
+                     "reports_per_s": len(reports) / elapsed, "tokens_per_s": tokens / elapsed})
+
+    # The extraction of a model/method/prompt is shared by the sections that only change the postprocessing
+    extractions = {}
+    for section in config["sections"]:
+        method = section["method"]
+        for model_name in section.get("models", list(config["models"])):
+            model_cfg = config["models"][model_name]
+            for prompt, prompt_label in config["prompts"].items():
+                key = (model_name, method, prompt)
+                if key not in extractions:
+                    extractions[key] = run_extraction_cell(method, model_cfg, prompt, reports)
+                answers, timing = extractions[key]
+
+                df_pred = predictions(method, prompt, answers, df_true)
+                if section.get("regex_confirmation"):
+                    df_pred, _ = confirm_values(df_pred)
+                name = "_".join([model_name, method, prompt] + (["regex"] if section.get("regex_confirmation") else []))
+                write_table(df_pred, os.path.join(output_dir, f"{name}.parquet"))
+
+                metrics = evaluate_FFR_iFR(df_true, df_pred, verbose=False)
+                rows.append({"section": section["title"],
+                             "label": row_label(model_cfg, prompt_label, method, section.get("regex_confirmation")),
+                             "method": method, "model": model_name, "prompt": prompt,
+                             "regex_confirmation": bool(section.get("regex_confirmation")), **metrics, **timing})
+                print(f"{rows[-1]['label']}: F1 {metrics['f1']}, {timing['reports_per_s']:.1f} reports/s")
+
+    results = pd.DataFrame(rows)
+    results.to_csv(os.path.join(output_dir, "metrics.csv"), index=False)
+    return results
+
+
+def latex_table(results, timing_columns=False):
+    """Results table in the format of results/results.tex, one \\midrule section per config section."""
+    def fmt(v, digits=3):
+        return "N/A" if pd.isna(v) else f"{v:.{digits}f}"
+
+    header = "l|llll|l" + ("|lll" if timing_columns else "")
+    lines = [f"\\begin{{tabular}}{{{header}}}", "\\toprule",
+             "& Extraction  &  &  & & Value" + (" & & & " if timing_columns else "") + " \\\\",
+             "Model  & Accuracy & Precision & Recall & F1 & Accuracy"
+             + (" & Time (s) & Reports/s & Tokens/s" if timing_columns else "") + " \\\\"]
+    n_cols = 6 + (3 if timing_columns else 0)
+    section = object()
+    for _, row in results.iterrows():
+        if row["section"] != section:
+            section = row["section"]
+            lines.append("\\midrule")
+            if isinstance(section, str):
+                lines.append(section + " &" * (n_cols - 1) + " \\\\")
+                lines.append("\\midrule")
+        cells = [row["label"], fmt(row["accuracy"]), fmt(row["precision"]), fmt(row["recall"]), fmt(row["f1"]),
+                 fmt(row["value_accuracy"])]
+        if timing_columns:
+            cells += [fmt(row["wall_time_s"], 1), fmt(row["reports_per_s"], 2), fmt(row["tokens_per_s"], 1)]
+        lines.append(" & ".join(cells) + " \\\\")
+    lines += ["\\bottomrule", "\\end{tabular}"]
+    return "\n".join(lines)
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", nargs="?", default="grid_config.json")
+    args = parser.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    results = run_grid(config)
+    tex_path = config.get("tex", os.path.join(config["output_dir"], "results.tex"))
+    os.makedirs(os.path.dirname(tex_path) or ".", exist_ok=True)
+    with open(tex_path, "w", encoding="utf-8") as f:
+        f.write(latex_table(results, config.get("timing_columns", False)))
+    print(f"Table written to {tex_path}")
@@ -0,0 +1,155 @@
+"""Offline performance benchmark of the pipeline on synthetic reports (see synthetic_reports.py).
+
+Times each stage that does not need a model (section splitting, regex extraction, RegEx confirmation,
+JSON normalisation and evaluation) and the LLM extraction paths against a deterministic stub model that
+answers with the regex baseline values, so only the code around the model is measured. Each stage reports
+its best wall time over the repeats, reports/s and the peak memory allocated while it runs (tracemalloc,
+measured in a separate run so it does not slow down the timed ones).
+The import time of the modules that tools import is measured in a fresh interpreter and checked against
+IMPORT_TIME_BUDGET_S; the suite exits with an error when one is over it.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+import pandas as pd
+import extractor_baseline_llms as baseline_llms
+from benchmark_grid import stub_answer, predictions, run_extraction_cell
+from evaluation import evaluate_FFR_iFR
+from extractor_baseline_regex import remove_accents, split_sections_batch, top_separators, run_extraction
+from postprocessing_constrained import format_extractions
+from postprocessing_regex import confirm_values
+from synthetic_reports import generate
+
+# Importing the constrained backbone must not load the model; guidance and pandas take about 1.5s
+IMPORT_TIME_BUDGET_S = 3.0
+IMPORT_MODULES = ["backbone_extractor_constrained_llms", "extractor_constrained_llms", "extractor_baseline_llms",
+                  "extractor_baseline_regex"]
+
+
+class StubLLM:
+    """Deterministic stand-in for the Ollama client: answers with the regex baseline values of the report
+    in the question, with the same generation_info fields as Ollama."""
+    model = "stub"
+
+    def generate(self, prompts):
+        generations = []
+        for question in prompts:
+            report = question.rsplit("Relatório:\n    |", 1)[-1].rsplit("|", 1)[0]
+            answer = stub_answer("baseline", report)
+            info = {"prompt_eval_count": len(question) // 4, "eval_count": len(answer) // 4,
+                    "prompt_eval_duration": 0, "eval_duration": 0}
+            generations.append([SimpleNamespace(text=answer, generation_info=info)])
+        return SimpleNamespace(generations=generations)
+
+    def invoke(self, question):
+        return self.generate([question]).generations[0][0].text
+
+
+def run_stage(fn, repeat):
+    """Best wall time of fn over repeat runs and the peak memory of one more run."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def import_time(module):
+    """Seconds to import module in a new interpreter, so nothing is already in sys.modules."""
+    code = f"import time; t0 = time.perf_counter(); import {module}; print(time.perf_counter() - t0)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def check_import_times(modules=IMPORT_MODULES, budget=IMPORT_TIME_BUDGET_S):
+    """Import time of each module; returns the ones over the budget."""
+    slow = []
+    for module in modules:
+        elapsed = import_time(module)
+        print(f"import {module:<40} {elapsed:6.2f}s{'  OVER BUDGET' if elapsed > budget else ''}")
+        if elapsed > budget:
+            slow.append(module)
+    return slow
+
+
+def stages(df_true, workdir):
+    """Stage name -> function, on the reports of df_true. Inputs of each stage are prepared outside of it."""
+    reports = df_true["Conclusões"].tolist()
+    folded = [remove_accents(r) for r in reports]
+    df_pred = run_extraction(df_true)
+    df_confirm = df_pred[["Conclusões"] + [c for c in df_pred.columns if c.endswith(("_FFR", "_iFR"))]]
+    answers = [stub_answer("constrained", r) for r in reports]
+    df_extracted = pd.DataFrame({"id": df_true["id"], "Conclusões": df_true["Conclusões"], "extracted": answers})
+    stub = {"label": "stub", "backend": "stub"}
+
+    def baseline_llm():
+        # format_FFR_iFR prints every answer
+        with contextlib.redirect_stdout(io.StringIO()):
+            baseline_llms.get_FFR_iFR(df_true[["id", "Conclusões"]].copy(), os.path.join(workdir, "FFR_iFR.parquet"),
+                                      "zero_shot", StubLLM(), prefilter=True, with_telemetry=True)
+
+    def constrained_llm():
+        cell_answers, _ = run_extraction_cell("constrained", stub, "zero_shot", reports)
+        predictions("constrained", "zero_shot", cell_answers, df_true)
+
+    return {
+        "section splitting": lambda: split_sections_batch(folded, top_separators),
+        "regex extraction": lambda: run_extraction(df_true),
+        "regex confirmation": lambda: confirm_values(df_confirm),
+        "JSON normalisation": lambda: format_extractions(df_extracted),
+        "evaluation": lambda: evaluate_FFR_iFR(df_true, df_pred, verbose=False),
+        "baseline LLM (stub)": baseline_llm,
+        "constrained LLM (stub)": constrained_llm,
+    }
+
+
+def run_suite(sizes, repeat=3, seed=0, mean_sentences=8, only=None):
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in sizes:
+            df_true = generate(n, seed, mean_sentences)
+            for name, fn in stages(df_true, workdir).items():
+                if only and name not in only:
+                    continue
+                # tqdm progress bars of the LLM paths
+                with contextlib.redirect_stderr(io.StringIO()):
+                    elapsed, peak = run_stage(fn, repeat)
+                rows.append({"stage": name, "reports": n, "time_s": elapsed, "reports_per_s": n / elapsed,
+                             "peak_mb": peak / 2**20})
+                print(f"{name:<24} {n:>8} reports {elapsed:8.3f}s {n / elapsed:10.0f} reports/s "
+                      f"{peak / 2**20:8.1f} MB peak")
+    return pd.DataFrame(rows)
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="numbers of synthetic reports")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (the best one is kept)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mean-sentences", type=int, default=8, help="median report length in sentences")
+    parser.add_argument("--stages", nargs="+", help="only run these stages")
+    parser.add_argument("--output", default="results/benchmark_suite.csv")
+    args = parser.parse_args()
+
+    slow = check_import_times()
+    results = run_suite(args.sizes, args.repeat, args.seed, args.mean_sentences, args.stages)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    results.to_csv(args.output, index=False)
+    print(f"Results written to {args.output}")
+    if slow:
+        sys.exit(f"Import time over {IMPORT_TIME_BUDGET_S}s: {', '.join(slow)}")
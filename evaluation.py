@@ -1,110 +1,143 @@
 """Code for evaluation of the results."""
 
+import argparse
 import os
 import pandas as pd
 import numpy as np
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
-from sklearn.metrics import confusion_matrix, mean_squared_error
-from sklearn.preprocessing import LabelEncoder
-from sympy import true
-import sys
-
-
-def is_valid(val):
-    if pd.isna(val):  # NaN is allowed
-        return True
-    try:
-        num = float(val)
-        return 0 <= num <= 100 #sometimes FFR/iFR can be slightly above 1, and in one case it is 84 meaning 0.84
-    except:
-        return False
-
-
-def evaluate_binary(y_true, y_pred):
-    """Evaluate binary classification"""
-    # Print the 2-entry table for counts of values 0 and 1
-    counts_table = pd.crosstab(y_true, y_pred, rownames=['True'], colnames=['Predicted'])
-    print(counts_table)
-     
-    accuracy = round(accuracy_score(y_true, y_pred), 3)
-    precision = round(precision_score(y_true, y_pred), 3)
-    recall = round(recall_score(y_true, y_pred), 3)
-    f1 = round(f1_score(y_true, y_pred), 3)
-    
-    print("Accuracy: " + str(accuracy))
-    print("Precision: " + str(precision))
-    print("Recall: " + str(recall))
-    print("F1 Score: " + str(f1))
-
-
-def evaluate_FFR_iFR(df_true, df_pred):
+from storage import ffr_ifr_cols as columns, iter_batches
+
+
+def parse_values(df, missing=()):
+    """Parse the FFR/iFR columns of df once into (rows, columns) arrays:
+    values: floats with decimal commas accepted, NaN when empty or not a number
+    present: the cell has a value (not NaN and not one of the missing markers)
+    valid: the cell is empty, or parses as a number as written (a decimal comma is not a number) and is
+    between 0 and 100, since FFR/iFR can be slightly above 1 and is sometimes written as 84 for 0.84."""
+    shape = (len(df), len(columns))
+    values = np.full(shape, np.nan)
+    present = np.zeros(shape, dtype=bool)
+    valid = np.ones(shape, dtype=bool)
+    for j, c in enumerate(columns):
+        col = df[c]
+        if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+            strict = lenient = col.to_numpy(dtype=float)
+            present[:, j] = ~np.isnan(strict)
+        else:
+            present[:, j] = (col.notna() & ~col.isin(missing)).to_numpy()
+            # Most cells are empty, so only the present ones are parsed
+            rows = np.flatnonzero(present[:, j])
+            text = col.iloc[rows].astype(str).str.strip()
+            strict, lenient = np.full(len(df), np.nan), np.full(len(df), np.nan)
+            strict[rows] = pd.to_numeric(text, errors="coerce").to_numpy(dtype=float)
+            lenient[rows] = pd.to_numeric(text.str.replace(",", "."), errors="coerce").to_numpy(dtype=float)
+        values[:, j] = lenient
+        with np.errstate(invalid="ignore"):
+            valid[:, j] = ~present[:, j] | ((strict >= 0) & (strict <= 100))
+    return values, present, valid
+
+
+class EvaluationCounts:
+    """Confusion counts of the presence/absence of the values and matches of the values, accumulated over
+    chunks of rows so that a result set of any size is scored in bounded memory."""
+
+    def __init__(self):
+        self.tp = self.fp = self.fn = self.tn = 0
+        self.matches = self.compared = 0
+        self.missing = self.extracted = self.out_of_format = 0
+
+    def update(self, df_true, df_pred):
+        """Add the rows of a chunk (df_true and df_pred row i is the same report). Returns the parsed predictions."""
+        if len(df_true) != len(df_pred):
+            raise ValueError(f"Ground truth and predictions have different lengths ({len(df_true)} vs {len(df_pred)})")
+        true_values, true_present, _ = parse_values(df_true)
+        pred_values, pred_present, pred_valid = parse_values(df_pred, missing=("NA",))
+
+        self.tp += int(np.count_nonzero(true_present & pred_present))
+        self.fp += int(np.count_nonzero(~true_present & pred_present))
+        self.fn += int(np.count_nonzero(true_present & ~pred_present))
+        self.tn += int(np.count_nonzero(~true_present & ~pred_present))
+
+        # Values present in both
+        mask = ~np.isnan(pred_values) & ~np.isnan(true_values)
+        self.compared += int(np.count_nonzero(mask))
+        self.matches += int(np.count_nonzero(pred_values[mask] == true_values[mask]))
+
+        self.extracted += int(np.count_nonzero(pred_present))
+        self.missing += pred_present.size - int(np.count_nonzero(pred_present))
+        self.out_of_format += int(np.count_nonzero(~pred_valid))
+        return pred_values, pred_present, pred_valid
+
+    def confusion(self):
+        """2x2 table of the presence/absence counts (rows: true, columns: predicted)."""
+        return pd.DataFrame([[self.tn, self.fp], [self.fn, self.tp]],
+                            index=pd.Index([0, 1], name="True"), columns=pd.Index([0, 1], name="Predicted"))
+
+    def metrics(self):
+        total = self.tp + self.fp + self.fn + self.tn
+        precision = self.tp / (self.tp + self.fp) if self.tp + self.fp else 0.0
+        recall = self.tp / (self.tp + self.fn) if self.tp + self.fn else 0.0
+        f1 = 2 * self.tp / (2 * self.tp + self.fp + self.fn) if self.tp else 0.0
+        value_accuracy = self.matches / self.compared if self.compared else float("nan")
+        return {"accuracy": round((self.tp + self.tn) / total, 3) if total else float("nan"),
+                "precision": round(precision, 3), "recall": round(recall, 3), "f1": round(f1, 3),
+                "value_accuracy": round(value_accuracy, 3), "missing": self.missing,
+                "extracted": self.extracted, "out_of_format": self.out_of_format}
+
+
+def evaluate_FFR_iFR(df_true, df_pred, verbose=True):
     """Evaluate the extraction of FFR and iFR in 3 phases:
     1. Evaluate the format: are the values numeric?
     2. Evaluate the presence/absence of values
-    3. Evaluate the MSE for the values that are present in both DataFrames"""
-
-    #Select columns for evaluation
-    columns = ["Tronco_Comum_FFR", "Descendente_Anterior_FFR", "Circunflexa_FFR", "Coronária_Direita_FFR", "Outras_artérias_FFR", "Tronco_Comum_iFR", "Descendente_Anterior_iFR", "Circunflexa_iFR", "Coronária_Direita_iFR", "Outras_artérias_iFR"]
-    df_pred = df_pred[columns]
-    df_true = df_true[columns]
-    
-    #Replace "NA" with None to be able to count missing values
-    df_pred = df_pred.replace("NA", None)
-
-    #Number of missing values in each column
-    missing = df_pred.isna().sum().sum()
-    print(f"Missing: {missing}")
-    
-    #Number of values present
-    total_values = df_pred.size - missing
-    print(f"Number of extracted values: {total_values}")
-    
-    #How many where non-numeric?
-    out_of_format_values = []
-
-    for c in df_pred.columns:
-        mask_invalid = ~df_pred[c].apply(is_valid)
-        if mask_invalid.any():
-            out_of_format_values.append(
-                df_pred.loc[mask_invalid, c]
-                .to_frame(name="value")
-                .assign(column=c)
-            )
-
-    if out_of_format_values:
-        out_of_format_df = pd.concat(out_of_format_values)
-    else:
-        out_of_format_df = pd.DataFrame(columns=["value", "column"])
-
-    print(f"Out of format: {len(out_of_format_df)}")
-    print(out_of_format_df)
-    
-
-    # Flatten the DataFrames and create binary presence/absence arrays
-    print("Presence/Absence evaluation")
-    true_presence = df_true.notna().values.flatten().astype(int)
-    pred_presence = df_pred.notna().values.flatten().astype(int)
-    evaluate_binary(true_presence, pred_presence)
-    
-    # Convert all values to floats (handle commas and NaNs)
-    for df in [df_pred, df_true]:
-        for col in df.columns:
-            df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.').str.strip(), errors='coerce')
-
-    # Flatten the DataFrames for comparison
-    pred_values = df_pred.values.flatten()
-    true_values = df_true.values.flatten()
-
-    # Mask to ignore NaNs in true values
-    mask = ~np.isnan(pred_values) & ~np.isnan(true_values)
-
-    # Compute accuracy: how many predictions match true values
-    accuracy = np.mean(pred_values[mask] == true_values[mask])
-    print(f"Accuracy: {accuracy}")
+    3. Evaluate the accuracy for the values that are present in both DataFrames
+    Returns the metrics (presence/absence accuracy, precision, recall and F1, and the value accuracy)."""
+    counts = EvaluationCounts()
+    _, _, pred_valid = counts.update(df_true, df_pred)
+    metrics = counts.metrics()
+
+    if verbose:
+        rows, cols = np.nonzero(~pred_valid)
+        out_of_format_df = pd.DataFrame({"value": df_pred[columns].to_numpy()[rows, cols],
+                                         "column": np.array(columns)[cols]}, index=df_pred.index[rows])
+        print(f"Missing: {metrics['missing']}")
+        print(f"Number of extracted values: {metrics['extracted']}")
+        print(f"Out of format: {metrics['out_of_format']}")
+        print(out_of_format_df)
+        print("Presence/Absence evaluation")
+        print(counts.confusion())
+        for name in ["accuracy", "precision", "recall", "f1"]:
+            print(f"{name.capitalize() if name != 'f1' else 'F1 Score'}: {metrics[name]}")
+        print(f"Value accuracy: {metrics['value_accuracy']}")
+    return metrics
+
+
+def evaluate_files(true_path, pred_path, chunksize=100000):
+    """evaluate_FFR_iFR of two files with the same rows in the same order, read chunk by chunk.
+    Chunks of the two files are realigned when they do not have the same boundaries."""
+    counts = EvaluationCounts()
+    # CSV and Excel values are evaluated as written, their format is part of the evaluation
+    true_chunks = iter_batches(true_path, columns, chunksize, convert=False)
+    pred_chunks = iter_batches(pred_path, columns, chunksize, convert=False)
+    true_buffer = pred_buffer = None
+    while True:
+        if true_buffer is None or not len(true_buffer):
+            true_buffer = next(true_chunks, None)
+        if pred_buffer is None or not len(pred_buffer):
+            pred_buffer = next(pred_chunks, None)
+        if true_buffer is None or pred_buffer is None:
+            if true_buffer is not None or pred_buffer is not None:
+                raise ValueError(f"{true_path} and {pred_path} do not have the same number of rows")
+            return counts.metrics()
+        n = min(len(true_buffer), len(pred_buffer))
+        counts.update(true_buffer.iloc[:n], pred_buffer.iloc[:n])
+        true_buffer, pred_buffer = true_buffer.iloc[n:], pred_buffer.iloc[n:]
 
 
 #RUN
-results_folder = "<model_name_folder>"
-df_true = pd.read_csv('data/reports_groundtruth.csv')
-df_pred = pd.read_excel(f'results/{results_folder}/extraction_results.xlsx')
-evaluate_FFR_iFR(df_true, df_pred)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--true", default="data/reports_groundtruth.csv")
+    parser.add_argument("--pred", default="results/<model_name_folder>/extraction_results.parquet",
+                        help="extraction results (CSV, Parquet or Excel)")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows per chunk of CSV and Parquet files")
+    args = parser.parse_args()
+    print(evaluate_files(args.true, args.pred, args.chunksize))
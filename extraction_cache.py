@@ -0,0 +1,124 @@
+"""On-disk cache of extraction results shared by all the extractors.
+
+Results are stored in SQLite under a hash of everything that determines them: the report text, the model,
+the prompt variant and the schema. Writes are batched: new results and the last_used times of the hits are
+written every flush_every operations and on flush()/close(). When the cache holds more than max_entries results,
+the least recently used ones are evicted.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ExtractionCache:
+    def __init__(self, path="cache/extraction.sqlite", max_entries=1_000_000, flush_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        # New results and last_used times of the hits not written yet, stored in one transaction by flush()
+        self.pending = {}
+        self.touched = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Shared by the threads of the concurrent Ollama extraction
+        self.lock = threading.Lock()
+        # Worker processes wait for each other's flush instead of failing with "database is locked"
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(text, model, variant, schema=None):
+        """Hash of the inputs that determine an extraction result."""
+        payload = json.dumps([str(text), model, variant, schema], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached result or None. The hit only updates last_used at the next flush."""
+        with self.lock:
+            if key in self.pending:
+                value = self.pending[key]
+            else:
+                row = self.conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                value = row[0]
+                self.touched[key] = time.time()
+            self.hits += 1
+            self._flush_if_full()
+        return json.loads(value)
+
+    def put(self, key, value):
+        """Store a result (written at the next flush). Failed extractions (None) are not cached."""
+        if value is None:
+            return
+        with self.lock:
+            self.pending[key] = json.dumps(value, ensure_ascii=False)
+            self.touched.pop(key, None)
+            self._flush_if_full()
+
+    def flush(self):
+        """Write the pending results and last_used times in one transaction, then evict the least recently
+        used results if the table holds more than max_entries."""
+        with self.lock:
+            self._flush()
+
+    def _flush_if_full(self):
+        if len(self.pending) + len(self.touched) >= self.flush_every:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending and not self.touched:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("UPDATE results SET last_used = ? WHERE key = ?",
+                                  [(t, key) for key, t in self.touched.items()])
+            self.conn.executemany("INSERT OR REPLACE INTO results (key, value, last_used) VALUES (?, ?, ?)",
+                                  [(key, value, now) for key, value in self.pending.items()])
+            # Counted from the table, as other processes may have added results too
+            (size,) = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()
+            if size > self.max_entries:
+                self._evict(size - self.max_entries)
+        self.pending.clear()
+        self.touched.clear()
+
+    def _evict(self, n):
+        """Delete the n least recently used results."""
+        self.conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (n,)
+        )
+
+    def cached(self, fn, text, model, variant, schema=None):
+        """Return fn(text) from the cache, computing and storing it on a miss."""
+        key = self.key(text, model, variant, schema)
+        value = self.get(key)
+        if value is None:
+            value = fn(text)
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"Extraction cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)"
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def source_fingerprint(path):
+    """Hash of a source file, used as the 'model' of code-based extractors such as the regex baseline."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
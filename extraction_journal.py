@@ -0,0 +1,167 @@
+"""Append-only journal for the extraction results.
+
+Each extracted report is appended as one JSON line ({"id": ..., "extracted": ...}) by a background
+writer thread, so a run can be resumed after a crash and the results only need to be written once.
+The journal can be followed while it is written (JournalTail), and a run can be asked to stop with its abort file.
+"""
+
+import json
+import os
+import queue
+import threading
+import pandas as pd
+from storage import TableWriter
+
+
+class JournalWriter:
+    """Append records to a JSONL journal from a background thread."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if resume and os.path.exists(path):
+            self.file = open(path, "a", encoding="utf-8")
+            # A crash may have left half a line at the end of the journal
+            if self.file.tell() > 0 and not _ends_with_newline(path):
+                self.file.write("\n")
+        else:
+            # A new run starts a new file (a new inode) instead of truncating the journal, so a JournalTail
+            # following it notices the restart even when the new run has already written past its offset
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            open(tmp_path, "w", encoding="utf-8").close()
+            os.replace(tmp_path, path)
+            self.file = open(path, "a", encoding="utf-8")
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            # Only flush when the writer has caught up, so bursts are written together
+            if self.queue.empty():
+                self.file.flush()
+        self.file.flush()
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def read_journal(path):
+    """Yield the records of a journal, skipping a truncated last line."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def journaled_ids(path):
+    """Ids of the reports already in the journal."""
+    return {record["id"] for record in read_journal(path)}
+
+
+class JournalTail:
+    """Follow a journal that is still being written: each read returns the records appended since the last one.
+    Only complete lines are read, a line being written is left for the next read."""
+
+    # Bytes at the start of the journal compared between reads to notice a new run
+    HEAD_BYTES = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.inode = None
+        self.head = b""
+        # Number of times the journal was started again by a new run
+        self.restarts = 0
+
+    def read_new(self, max_bytes=2**26):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            st = os.fstat(f.fileno())
+            # A new run replaces the journal with a new file; a shorter file or other first bytes also mean
+            # it was started again (e.g. by an older writer that truncated it)
+            if self.inode is not None and not (st.st_ino == self.inode and st.st_size >= self.offset
+                                               and f.read(len(self.head)) == self.head):
+                self.offset = 0
+                self.head = b""
+                self.restarts += 1
+            self.inode = st.st_ino
+            f.seek(self.offset)
+            data = f.read(max_bytes)
+            end = data.rfind(b"\n") + 1
+            self.offset += end
+            if len(self.head) < self.HEAD_BYTES and self.offset > len(self.head):
+                f.seek(0)
+                self.head = f.read(min(self.offset, self.HEAD_BYTES))
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return records
+
+
+def abort_path(journal_path):
+    """File that asks the extraction writing the journal to stop (see live_evaluation.py)."""
+    return os.path.splitext(journal_path)[0] + ".abort"
+
+
+def request_abort(journal_path, reason):
+    with open(abort_path(journal_path), "w", encoding="utf-8") as f:
+        f.write(reason + "\n")
+
+
+def abort_requested(journal_path):
+    """Reason of the abort request of the journal, None if there is none."""
+    try:
+        with open(abort_path(journal_path), "r", encoding="utf-8") as f:
+            return f.read().strip() or "abort requested"
+    except FileNotFoundError:
+        return None
+
+
+def clear_abort(journal_path):
+    if os.path.exists(abort_path(journal_path)):
+        os.remove(abort_path(journal_path))
+
+
+def compact_journal(journal_path, input_path, output_path, chunksize=10000, columns=("extracted",)):
+    """Write the input table with the journaled results in an 'extracted' column (and any other journaled
+    columns) to a Parquet file, reading the input in chunks."""
+    records = list(read_journal(journal_path))
+    values = {col: {record["id"]: record.get(col) for record in records} for col in columns}
+
+    with TableWriter(output_path) as writer:
+        for chunk in pd.read_csv(input_path, chunksize=chunksize):
+            for col in columns:
+                chunk[col] = chunk["id"].map(values[col])
+            writer.write(chunk)
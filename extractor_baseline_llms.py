@@ -1,8 +1,18 @@
 """Extract the FFR and iFR values from the reports using a LLM"""
 
-from langchain_ollama import OllamaLLM
+import argparse
+from langchain_ollama import ChatOllama, OllamaLLM
+from langchain_core.messages import HumanMessage, SystemMessage
 import pandas as pd 
 import json
+import textwrap
+import time
+from functools import lru_cache
+import telemetry
+from extraction_cache import ExtractionCache
+from prefilter import has_candidates, trim_report
+from storage import write_table
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 tqdm.pandas()
 
@@ -10,9 +20,56 @@ OLLAMA_PROTOCOL="http"
 OLLAMA_HOST="localhost"
 OLLAMA_PORT="11434"
 
+# Number of requests kept open against the server. Should match the OLLAMA_NUM_PARALLEL
+# setting of the server, otherwise the extra requests just wait in the server queue.
+MAX_IN_FLIGHT = 1
+# Seconds before a single request is abandoned (None waits forever)
+REQUEST_TIMEOUT = None
+# Skip the LLM for the reports without any FFR/iFR candidate value (see prefilter.py)
+PREFILTER = False
+# Send only the sentences with measure, vessel or stent keywords to the LLM (see prefilter.py)
+TRIM_REPORTS = False
+# Add the per-report token and latency columns to the output and write the run summary next to it (see telemetry.py)
+TELEMETRY = False
+# Send the instructions and examples as a system prompt that is the same for every report and the report as a
+# separate message, so the server can reuse the evaluated prompt prefix between reports (see make_chat_llm)
+PREFIX_PROMPTS = False
+# How long Ollama keeps the model, and its prompt cache, loaded after a request
+KEEP_ALIVE = "30m"
+# Client settings that change the answer, part of the extraction cache key (see cache_variant)
+GENERATION_OPTIONS = ["temperature", "top_k", "top_p", "seed", "num_ctx", "num_predict", "repeat_penalty",
+                      "repeat_last_n", "mirostat", "mirostat_eta", "mirostat_tau", "tfs_z", "stop", "format", "reasoning"]
 
-def extract_FFR_iFR(report, llm, question_type):
-    """Extract the FFR and iFR"""
+ARTERIES = ["Tronco Comum",
+            "Descendente Anterior",
+            "Circunflexa",
+            "Coronária Direita",
+            "Outras artérias"]
+
+
+def make_llm(ollama_model, base_url=None, timeout=REQUEST_TIMEOUT):
+    """Create the Ollama client. The timeout applies to each request."""
+    if base_url is None:
+        base_url = f'{OLLAMA_PROTOCOL}://{OLLAMA_HOST}:{OLLAMA_PORT}'
+    return OllamaLLM(base_url=base_url,
+                     model=ollama_model,
+                     temperature=0,
+                     client_kwargs={"timeout": timeout})
+
+
+def make_chat_llm(ollama_model, base_url=None, timeout=REQUEST_TIMEOUT, keep_alive=KEEP_ALIVE):
+    """Create the Ollama chat client used with the system prompt layout (PREFIX_PROMPTS)."""
+    if base_url is None:
+        base_url = f'{OLLAMA_PROTOCOL}://{OLLAMA_HOST}:{OLLAMA_PORT}'
+    return ChatOllama(base_url=base_url,
+                      model=ollama_model,
+                      temperature=0,
+                      keep_alive=keep_alive,
+                      client_kwargs={"timeout": timeout})
+
+
+def question_FFR_iFR(report, question_type):
+    """Build the question for a report"""
     
     question_zero_shot = """
     És um especialista em relatórios de angiografias/coronariografia e angioplastia.
@@ -336,10 +393,75 @@ def extract_FFR_iFR(report, llm, question_type):
     
     
     if question_type == "zero_shot":
-        return llm.invoke(question_zero_shot)
+        return question_zero_shot
     elif question_type == "one_shot":
-        return llm.invoke(question_one_shot)
-    return llm.invoke(question_one_shot_absurd)
+        return question_one_shot
+    return question_one_shot_absurd
+
+
+@lru_cache(maxsize=None)
+def system_prompt(question_type):
+    """The question of question_FFR_iFR without the report, compiled once per question type. The instructions
+    that follow the report in the question come before it, so the prompt is the same for every report."""
+    marker = "\0"
+    before, after = question_FFR_iFR(marker, question_type).split("|" + marker + "|")
+    head = before.rsplit("Relatório:", 1)[0]
+    return textwrap.dedent(head).strip() + "\n\n" + textwrap.dedent(after).strip()
+
+
+def prompt_messages(report, question_type):
+    """Chat messages of a report: the fixed system prompt, then the report."""
+    return [SystemMessage(system_prompt(question_type)), HumanMessage(f"Relatório:\n|{report}|")]
+
+
+def llm_prompt(report, llm, question_type):
+    """The prompt of a report for the client (messages for a chat client) and its text, which keys the cache."""
+    if isinstance(llm, ChatOllama):
+        messages = prompt_messages(report, question_type)
+        return messages, "\n\n".join(m.content for m in messages)
+    question = question_FFR_iFR(report, question_type)
+    return question, question
+
+
+def cache_variant(llm, question_type):
+    """The question type and the generation options set on the client (make_llm, make_chat_llm), which
+    with the model and the question determine a cached answer."""
+    options = {name: getattr(llm, name, None) for name in GENERATION_OPTIONS}
+    return [question_type, {name: value for name, value in options.items() if value is not None}]
+
+
+def extract_FFR_iFR(report, llm, question_type, cache=None):
+    """Extract the FFR and iFR. With a cache, the answer is reused when the model, its generation options and
+    the full question are unchanged."""
+    prompt, question = llm_prompt(report, llm, question_type)
+
+    def invoke(question):
+        answer = llm.invoke(prompt)
+        # Chat clients answer with a message
+        return getattr(answer, "content", answer)
+
+    if cache is None:
+        return invoke(question)
+    return cache.cached(invoke, question, llm.model, cache_variant(llm, question_type))
+
+
+def extract_FFR_iFR_timed(report, llm, question_type, cache=None):
+    """extract_FFR_iFR with the telemetry of the request, from the Ollama response metadata."""
+    prompt, question = llm_prompt(report, llm, question_type)
+    record = {}
+
+    def invoke(question):
+        t0 = time.perf_counter()
+        generation = llm.generate([prompt]).generations[0][0]
+        record.update(telemetry.from_ollama(generation.generation_info, (time.perf_counter() - t0) * 1000))
+        return generation.text
+
+    if cache is None:
+        answer = invoke(question)
+    else:
+        answer = cache.cached(invoke, question, llm.model, cache_variant(llm, question_type))
+    # No request was made when the answer came from the cache
+    return answer, record or telemetry.cached_record()
 
 
 def clean_results_JSON(result):
@@ -351,11 +473,7 @@ def clean_results_JSON(result):
 
 def format_FFR_iFR(results):
     """Format the results from a JSON with FFR and iFR to a dataframe with columns for each artery"""
-    arteries = ["Tronco Comum",
-                "Descendente Anterior",
-                "Circunflexa",
-                "Coronária Direita",
-                "Outras artérias"]
+    arteries = ARTERIES
     try:
         results = results.replace("NA", "null")
         data = json.loads(results)
@@ -376,9 +494,61 @@ def format_FFR_iFR(results):
         return values
 
 
-def get_FFR_iFR(df, path, question_type):
+def null_answer():
+    """Answer with every value null, given to the reports skipped by the pre-filter"""
+    return json.dumps({artery: {"FFR": None, "iFR": None} for artery in ARTERIES}, ensure_ascii=False)
+
+
+def extract_FFR_iFR_concurrent(df, llm, question_type, max_in_flight=MAX_IN_FLIGHT, cache=None, with_telemetry=False):
+    """Extract the FFR and iFR of every report with at most max_in_flight requests open at a time.
+    Returns the raw answers and their telemetry (None without with_telemetry) as a Series of (answer, telemetry)
+    indexed by report id, in the same order as df. A request that fails or times out gets an empty answer,
+    which format_FFR_iFR turns into NA, and no telemetry."""
+
+    def run(report):
+        try:
+            if with_telemetry:
+                return extract_FFR_iFR_timed(report, llm, question_type, cache)
+            return extract_FFR_iFR(report, llm, question_type, cache), None
+        except Exception as e:
+            print(f"Request failed: {e!r}")
+            return "", None
+
+    reports = df["Conclusões"].tolist()
+    results = [None] * len(reports)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {executor.submit(run, report): i for i, report in enumerate(reports)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            results[futures[future]] = future.result()
+
+    return pd.Series(results, index=df["id"].values, name="Results")
+
+
+def get_FFR_iFR(df, path, question_type, llm, max_in_flight=MAX_IN_FLIGHT, cache=None, prefilter=PREFILTER,
+                trim=TRIM_REPORTS, with_telemetry=TELEMETRY):
+    #Reports without FFR/iFR candidates get a null answer without calling the LLM
+    if prefilter:
+        candidates = df["Conclusões"].map(has_candidates)
+        print(f"Pre-filter: {(~candidates).sum()} of {len(df)} reports routed around the LLM")
+    else:
+        candidates = pd.Series(True, index=df.index)
+    results = pd.Series(null_answer(), index=df.index, dtype=object)
+    to_extract = df[candidates]
+    if trim:
+        to_extract = to_extract.assign(**{"Conclusões": to_extract["Conclusões"].map(trim_report)})
+
     #Extract a JSON with the FFR and iFR values from the reports
-    df["Results"] = df["Conclusões"].progress_apply(lambda report: extract_FFR_iFR(report, llm, question_type))
+    if max_in_flight > 1:
+        timed = extract_FFR_iFR_concurrent(to_extract, llm, question_type, max_in_flight, cache, with_telemetry).values
+    elif with_telemetry:
+        timed = to_extract["Conclusões"].progress_apply(lambda report: extract_FFR_iFR_timed(report, llm, question_type, cache)).values
+    else:
+        timed = to_extract["Conclusões"].progress_apply(lambda report: (extract_FFR_iFR(report, llm, question_type, cache), None)).values
+    results[candidates] = [answer for answer, _ in timed]
+    records = [None] * len(df)
+    for position, (_, record) in zip(candidates.values.nonzero()[0], timed):
+        records[position] = record
+    df["Results"] = results
 
     #Clean results
     df["Results_clean"] = df["Results"].apply(clean_results_JSON)
@@ -393,20 +563,52 @@ def get_FFR_iFR(df, path, question_type):
     columns = ["id", "Conclusões", "Tronco_Comum_FFR", "Descendente_Anterior_FFR", "Circunflexa_FFR", "Coronária_Direita_FFR", "Outras_artérias_FFR", "Tronco_Comum_iFR", "Descendente_Anterior_iFR", "Circunflexa_iFR", "Coronária_Direita_iFR", "Outras_artérias_iFR"]
     df = df[columns]
 
+    #Telemetry of the LLM requests (empty for the reports routed around the LLM or whose request failed)
+    if with_telemetry:
+        df = pd.concat([df, pd.DataFrame([r or {} for r in records], index=df.index, columns=telemetry.TELEMETRY_COLS)], axis=1)
+        stats, summary_path = telemetry.write_summary(records, path)
+        print(f"{telemetry.describe(stats)} ({summary_path})")
+
     #Save
-    df.to_csv(path, index=False)
+    write_table(df, path)
+
+
+def compare_prompt_layouts(reports, ollama_model, question_type, base_url=None):
+    """Mean prompt tokens evaluated by Ollama per report (prompt_eval_count), prefill and latency with the
+    single question and with the fixed system prompt. Ollama does not count the tokens of a prompt prefix it
+    reuses from its cache, so the difference is what the system prompt layout saves."""
+    rows = []
+    for layout, llm in [("question", make_llm(ollama_model, base_url)),
+                        ("system prompt", make_chat_llm(ollama_model, base_url))]:
+        for report in reports:
+            _, record = extract_FFR_iFR_timed(report, llm, question_type)
+            rows.append({"layout": layout, **record})
+    return pd.DataFrame(rows).groupby("layout", sort=False)[["prompt_tokens", "prefill_ms", "latency_ms"]].mean()
 
 
 #RUN
-#Input file
-reports_df = pd.read_csv('data/reports_groundtruth.csv')[["id", "Conclusões"]]
-
-#Choose model and query (question_type: zero_shot or one_shot or one_shot_absurd)
-ollama_model = "gpt-oss:20b"
-llm = OllamaLLM(base_url=f'{OLLAMA_PROTOCOL}://{OLLAMA_HOST}:{OLLAMA_PORT}',
-                model = ollama_model,
-                temperature=0)
-
-print("Getting FFR/iFR")
-question_type = "zero_shot"
-get_FFR_iFR(reports_df, f"results/<model_name_folder>/FFR_iFR.csv", question_type)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compare-layouts", type=int, metavar="N",
+                        help="only measure the prompt tokens per report of both prompt layouts on N reports")
+    parser.add_argument("--cache", action="store_true", help="reuse the answers of unchanged reports from the extraction cache")
+    args = parser.parse_args()
+
+    #Input file
+    reports_df = pd.read_csv('data/reports_groundtruth.csv')[["id", "Conclusões"]]
+
+    #Choose model and query (question_type: zero_shot or one_shot or one_shot_absurd)
+    ollama_model = "gpt-oss:20b"
+    question_type = "zero_shot"
+    if args.compare_layouts:
+        print(compare_prompt_layouts(reports_df["Conclusões"].head(args.compare_layouts).tolist(), ollama_model, question_type))
+        raise SystemExit
+    llm = make_chat_llm(ollama_model) if PREFIX_PROMPTS else make_llm(ollama_model)
+
+    print("Getting FFR/iFR")
+    cache = ExtractionCache() if args.cache else None
+    get_FFR_iFR(reports_df, f"results/<model_name_folder>/FFR_iFR.parquet", question_type, llm, cache=cache, prefilter=PREFILTER, trim=TRIM_REPORTS,
+                with_telemetry=TELEMETRY)
+    if cache is not None:
+        cache.close()
+        print(cache.stats())
\ No newline at end of file
@@ -1,30 +1,33 @@
 """Extraction with baseline RegEx."""
 
+import argparse
 import re
-import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import accumulate
 import pandas as pd
 import os
 import numpy as np
 import regex
-from sklearn.model_selection import train_test_split
-
-
-def remove_accents(text):
-    if isinstance(text, str):
-        text = unicodedata.normalize('NFKD', text)
-        return ''.join(c for c in text if not unicodedata.combining(c))
-    return text
-
-
-def create_cols(df, tex_col, top_separators):
-    top_separators = [remove_accents(x) for x in top_separators]
-    separators = top_separators
+import json
+from extraction_cache import ExtractionCache, source_fingerprint
+from storage import TableWriter, export_table, write_table
+import vocabulary
+from vocabulary import (remove_accents, top_separators, vessel_keywords, ffr_ifr_num_pattern, measure_keywords,
+                        MAX_WORD_DISTANCE, default_measure, stent_keywords, STENT_MAX_WORD_DISTANCE,
+                        stent_default_measure, ffr_ifr_cols, stent_cols, count_cols)
+
+
+def section_splitter(top_separators):
+    """Return a function that splits a report into its top sections ({separator: text}, "" if not found)."""
+    separators = [remove_accents(x) for x in top_separators]
     sep_pattern = '|'.join(regex.escape(sep) for sep in separators)
-    pattern = rf'({sep_pattern})'
+    pattern = regex.compile(rf'({sep_pattern})')
 
     def split_unordered(text):
     # splits text by separators if it does not find fills with "" 
-        parts = regex.split(pattern, text)
+        parts = pattern.split(text)
         result = {sep: "" for sep in separators}
 
         current_sep = None
@@ -35,12 +38,24 @@ def create_cols(df, tex_col, top_separators):
             elif current_sep:
                 result[current_sep] += (" " + part)
 
-        return pd.Series(result)
+        return result
 
-    split_df = df[tex_col].fillna('').astype(str).apply(remove_accents).apply(split_unordered)
-    df_full = pd.concat([df, split_df], axis=1)
-    df_full[top_separators] = df_full[top_separators].replace("", np.nan)
-    return df_full
+    return split_unordered
+
+
+def split_sections_batch(texts, top_separators):
+    """Split a column of accent-free reports into one list per section, with NaN for the sections not found."""
+    split_unordered = section_splitter(top_separators)
+    rows = [split_unordered(text) for text in texts]
+    return {sep: [row[sep] or np.nan for row in rows] for sep in (remove_accents(x) for x in top_separators)}
+
+
+def create_cols(df, tex_col, top_separators):
+    top_separators = [remove_accents(x) for x in top_separators]
+    texts = df[tex_col].fillna('').astype(str).apply(remove_accents)
+    sections = split_sections_batch(texts, top_separators)
+    split_df = pd.DataFrame(sections, index=df.index, dtype=object)
+    return pd.concat([df, split_df], axis=1)
 
 
 def structure_text_column(df, text_column, top_separators):
@@ -68,51 +83,159 @@ def typo_correction(df):
     return df
 
 
+WORD = re.compile(r'\w+')
+FFR_IFR_NUM = re.compile(ffr_ifr_num_pattern, re.IGNORECASE)
+STENT_LENGTH = re.compile(r'\b\d{1,3}\s*mm\b', re.IGNORECASE)
+# Longest span whose words ReportIndex.word_distance counts directly instead of indexing the report
+WORD_SCAN_CHARS = 2000
+
+
 def word_distance(text, start, end):
     """Count words between two character positions."""
     snippet = text[start:end]
     return len(re.findall(r'\w+', snippet))
 
 
-def extract_vessel_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure):
+def _keyword_starts(keywords, text):
+    """Start positions of each keyword in the text, overlapping occurrences included."""
+    starts = {}
+    for k in keywords:
+        positions = []
+        i = text.find(k)
+        while i != -1:
+            positions.append(i)
+            i = text.find(k, i + 1)
+        starts[k] = positions
+    return starts
+
+
+def _last_before(starts, keyword, pos):
+    """Start of the last occurrence of keyword that ends before pos, -1 if none (same as text[:pos].rfind(keyword))."""
+    j = bisect_right(starts, pos - len(keyword)) - 1
+    return starts[j] if j >= 0 else -1
+
+
+class KeywordEngine:
+    """Measure and vessel keyword tables, built once and shared by every report."""
+
+    def __init__(self, measure_keywords, vessel_keywords):
+        self.measures = list(dict.fromkeys(measure_keywords))
+        # (vessel name, lowercase keyword) in the order the vessels are searched
+        self.vessels = [(name, vessel.lower()) for name, keys in vessel_keywords for vessel in keys]
+        self.vessel_keys = list(dict.fromkeys(v for _, v in self.vessels))
+
+    def index(self, text):
+        return ReportIndex(self, text)
+
+
+@lru_cache(maxsize=None)
+def _keyword_engine(measure_keywords, vessel_keywords):
+    return KeywordEngine(measure_keywords, vessel_keywords)
+
+
+def keyword_engine(measure_keywords, vessel_keywords):
+    """KeywordEngine for these keywords, built once and reused for every report."""
+    return _keyword_engine(tuple(measure_keywords), tuple((name, tuple(keys)) for name, keys in vessel_keywords.items()))
+
+
+class ReportIndex:
+    """Keyword positions and word offsets of one report.
+    Finding the nearest keyword before a position and the word distance to it are binary searches."""
+
+    def __init__(self, engine, text):
+        self.engine = engine
+        self.text = text
+        # Only the keywords found in the report are searched, in the order of the engine
+        measure_starts = _keyword_starts(engine.measures, text)
+        self.measures = [(measure, measure_starts[measure]) for measure in engine.measures if measure_starts[measure]]
+        lowered = text.lower()
+        # Lowercasing the whole text is only equivalent to lowercasing each prefix when it keeps
+        # the length and there is no context dependent sigma
+        self.lower_ok = len(lowered) == len(text) and 'Σ' not in text
+        if self.lower_ok:
+            vessel_starts = _keyword_starts(engine.vessel_keys, lowered)
+            self.vessels = [(name, vessel, vessel_starts[vessel]) for name, vessel in engine.vessels if vessel_starts[vessel]]
+        self.word_starts = None
+
+    def _index_words(self):
+        # re.split with a group alternates non-word and word pieces, so the running lengths
+        # are the word boundaries: [end of gap, end of word, end of gap, ...]
+        offsets = list(accumulate(map(len, re.split(r'(\w+)', self.text))))
+        self.word_starts = offsets[0:-1:2]
+        self.word_ends = offsets[1::2]
+
+    def nearest_measure(self, pos):
+        nearest_measure, nearest_measure_pos = None, -1
+        for measure, starts in self.measures:
+            p = _last_before(starts, measure, pos)
+            if p > nearest_measure_pos:
+                nearest_measure = measure
+                nearest_measure_pos = p
+        return nearest_measure, nearest_measure_pos
+
+    def nearest_vessel(self, pos):
+        nearest_vessel, nearest_vessel_pos = None, -1
+        if self.lower_ok:
+            for vessel_name, vessel, starts in self.vessels:
+                p = _last_before(starts, vessel, pos)
+                if p > nearest_vessel_pos:
+                    nearest_vessel = vessel_name
+                    nearest_vessel_pos = p
+            return nearest_vessel, nearest_vessel_pos
+
+        before_text = self.text[:pos].lower()
+        for vessel_name, vessel in self.engine.vessels:
+            p = before_text.rfind(vessel)
+            if p > nearest_vessel_pos:
+                nearest_vessel = vessel_name
+                nearest_vessel_pos = p
+        return nearest_vessel, nearest_vessel_pos
+
+    def word_distance(self, start, end):
+        """Same as word_distance(text, start, end). Short spans are counted in place, long ones by binary
+        search in the word offsets of the report, so a long report is only scanned once."""
+        if start >= end:
+            return 0
+        if end - start <= WORD_SCAN_CHARS:
+            return len(WORD.findall(self.text, start, end))
+        if self.word_starts is None:
+            self._index_words()
+        n = bisect_left(self.word_starts, end) - bisect_left(self.word_starts, start)
+        # A word cut by the start of the slice still counts as one
+        i = bisect_right(self.word_starts, start) - 1
+        if i >= 0 and self.word_starts[i] < start < self.word_ends[i]:
+            n += 1
+        return n
+
+
+def vessel_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure):
     # default_measure = if no measure name (iFR / FFR) is found defaults to this (chose iFR or FFR)
 
     # find all matches for numbers like 0.XX or 0,XX
-    num_pattern = r'\b0[.,]\d+\b'
-    matches = [(m.group(), m.start()) for m in re.finditer(num_pattern, text,re.IGNORECASE)]
+    matches = [(m.group(), m.start()) for m in FFR_IFR_NUM.finditer(text)]
     results = {}
     
+    index = keyword_engine(measure_keywords, vessel_keywords).index(text) if matches else None
+
     for num, pos in matches:
 
         # look only at text before match
         num_val = float(num.replace(',', '.'))
-        before_text = text[:pos]
         
         # Find closest measure before number - case sensisitve
-        nearest_measure, nearest_measure_pos = None, -1
-        for measure in measure_keywords:
-            p = before_text.rfind(measure)
-            if p > nearest_measure_pos:
-                nearest_measure = measure
-                nearest_measure_pos = p
+        nearest_measure, nearest_measure_pos = index.nearest_measure(pos)
         
         # Find closest vessel before number - should be case insentitive
-        nearest_vessel, nearest_vessel_pos = None, -1
-        for vessel_name, vessel_key in vessel_keywords.items():
-            for vessel in vessel_key:
-                p = before_text.lower().rfind(vessel.lower())
-                if p > nearest_vessel_pos:
-                    nearest_vessel = vessel_name
-                    nearest_vessel_pos = p
+        nearest_vessel, nearest_vessel_pos = index.nearest_vessel(pos)
         
         # Calculate distances (in words)
         if nearest_measure_pos != -1:
-            measure_distance = word_distance(text, nearest_measure_pos, pos)
+            measure_distance = index.word_distance(nearest_measure_pos, pos)
         else:
             measure_distance = float('inf')
         
         if nearest_vessel_pos != -1:
-            vessel_distance = word_distance(text, nearest_vessel_pos, pos)
+            vessel_distance = index.word_distance(nearest_vessel_pos, pos)
         else:
             vessel_distance = float('inf')
         
@@ -139,46 +262,37 @@ def extract_vessel_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DI
     # keep only the values
     for key, value in results.items():
         results[key] = value[0]
-    return pd.Series(results)
+    return results
 
 
-def extract_stent_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure):
+def extract_vessel_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure):
+    return pd.Series(vessel_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure))
+
+
+def stent_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure):
     if not isinstance(text, str):
-        return pd.Series()
+        return {}
 
     # Find all stent length patterns
-    num_pattern = r'\b\d{1,3}\s*mm\b'
-    matches = [(m.group(), m.start()) for m in re.finditer(num_pattern, text, re.IGNORECASE)]
+    matches = [(m.group(), m.start()) for m in STENT_LENGTH.finditer(text)]
     results = {}
 
+    index = keyword_engine(measure_keywords, vessel_keywords).index(text) if matches else None
+
     for num, pos in matches:
 
         # Extract only the number before "mm"
         num_val = re.findall(r'\d+', num)[0]
 
-        # look only at text before match
-        before_text = text[:pos]
-
         # Find closest measure before number - case sensitive
-        nearest_measure, nearest_measure_pos = None, -1
-        for measure in measure_keywords:
-            p = before_text.rfind(measure)
-            if p > nearest_measure_pos:
-                nearest_measure = measure
-                nearest_measure_pos = p
+        nearest_measure, nearest_measure_pos = index.nearest_measure(pos)
 
         # Find closest vessel before number - case insensitive
-        nearest_vessel, nearest_vessel_pos = None, -1
-        for vessel_name, vessel_key in vessel_keywords.items():
-            for vessel in vessel_key:
-                p = before_text.lower().rfind(vessel.lower())
-                if p > nearest_vessel_pos:
-                    nearest_vessel = vessel_name
-                    nearest_vessel_pos = p
+        nearest_vessel, nearest_vessel_pos = index.nearest_vessel(pos)
 
         # Calculate distances (in words)
-        measure_distance = word_distance(text, nearest_measure_pos, pos) if nearest_measure_pos != -1 else float('inf')
-        vessel_distance = word_distance(text, nearest_vessel_pos, pos) if nearest_vessel_pos != -1 else float('inf')
+        measure_distance = index.word_distance(nearest_measure_pos, pos) if nearest_measure_pos != -1 else float('inf')
+        vessel_distance = index.word_distance(nearest_vessel_pos, pos) if nearest_vessel_pos != -1 else float('inf')
 
         # Skip if both are too far
         if min(measure_distance, vessel_distance) > MAX_WORD_DISTANCE:
@@ -202,19 +316,20 @@ def extract_stent_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DIS
     for key in results:
         results[key] = '; '.join(results[key])
 
-    return pd.Series(results)
+    return results
 
 
-def extract_complications(text):
+def extract_stent_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure):
+    return pd.Series(stent_measures(text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure))
+
+
+def complication_flag(text, accents_removed=False):
     # if there is no text return 0 
     if not isinstance(text, str) or text.strip() == "":
-        return pd.Series({"Complicacoes": 0})
+        return 0
 
     # Normalize accents and case
-    text_norm = ''.join(
-        c for c in unicodedata.normalize('NFKD', text)
-        if not unicodedata.combining(c)
-    ).lower()
+    text_norm = (text if accents_removed else remove_accents(text)).lower()
 
     # Look for "complica" in text
     idx = text_norm.find("complica")
@@ -233,21 +348,19 @@ def extract_complications(text):
         else:
             value = 1
 
-    return pd.Series({"Complicacoes": value})
+    return value
 
 
+def extract_complications(text):
+    return pd.Series({"Complicacoes": complication_flag(text)})
 
-def extract_sucesso(text):
 
-    # Always return a Series
+def sucesso_flag(text, accents_removed=False):
     if not isinstance(text, str) or text.strip() == "":
-        return pd.Series({"Sucesso": 0})
+        return 0
 
     # Normalize accents and case
-    text_norm = ''.join(
-        c for c in unicodedata.normalize('NFKD', text)
-        if not unicodedata.combining(c)
-    ).lower()
+    text_norm = (text if accents_removed else remove_accents(text)).lower()
 
     # Check for "bom resultado" (accent-insensitive)
     if "bom resultado" in text_norm:
@@ -257,129 +370,193 @@ def extract_sucesso(text):
     else:
         value = 0
 
-    return pd.Series({"Sucesso": value})
-
-
-# Read data
-df = pd.read_csv('data/reports_groundtruth.csv',index_col=0)
-
-# Create columun with clean text
-df['clean_text'] = df['Conclusões'].fillna('').astype(str).apply(
-    lambda x: ''.join(
-        c for c in unicodedata.normalize('NFKD', x)
-        if not unicodedata.combining(c)
-    )
-)
-
-# create cols for each section of report
-top_separators =  ['CORONARIOGRAFIA','VENTRICULOGRAFIA','ANGIOPLASTIA',
-                       'CONCLUSAO','NOTA']
-df = structure_text_column(df,'clean_text', top_separators)
-# save processed data
-# df.to_csv('data/reports_train_clean.csv')
-
-
-# Name of predictions
-col_names = ['Tronco_Comum','Descendente_Anterior','Circunflexa','Coronária_Direita','Outras_artérias']
-# Names to look for in text
-locations = ['descendente anterior','tronco comum', 'coronaria direita','circunflexa', 'obtusa marginal']
-tipo = ['FFR', 'iFR']
-df_extracted = df[['clean_text','angioplastia', 'conclusao']].copy()
-
-# Define known vessel/region keywords and col names
-vessel_keywords = {'Descendente Anterior': ['Descendente Anterior'],
-    'Coronária Direita': ['Coronaria Direita', 'Descendente Posterior'],
-    'Tronco Comum': ['Tronco Comum'],
-    'Circunflexa': ['Circunflexa'],
-    'Outras_artérias': ['Marginal Obtusa','Ramo Intermedio', 'Bypass']}
-
-# Extract FFR/iFR
-# Define physiological measure keywords
-measure_keywords = ['iFR', 'FFR']
-MAX_WORD_DISTANCE = 40 # Define maximum word distance threshold
-default_measure = 'iFR'
-extracted = df_extracted['clean_text'].apply(extract_vessel_measures, args=(measure_keywords, vessel_keywords, MAX_WORD_DISTANCE,default_measure))
-df_extracted = pd.concat([df_extracted, extracted], axis=1)
-
-# Extract "tipo"
-df_extracted.loc[df_extracted['angioplastia'].isna(),'Tipo'] = 'Coronariografia'
-df_extracted.loc[df_extracted['angioplastia'].notna(),'Tipo'] = 'Coronariografia e Angioplastia	'
-
-
-# Extract stent measures
-# Define stent keywords
-measure_keywords = ['stent']
-MAX_WORD_DISTANCE = 20 # Define maximum word distance threshold
-default_measure = 'stent'
-extracted = df_extracted['angioplastia'].apply(extract_stent_measures, args=(measure_keywords, vessel_keywords, MAX_WORD_DISTANCE,default_measure))
-df_extracted = pd.concat([df_extracted, extracted], axis=1)
-
-# Extract complications
-extracted = df_extracted['clean_text'].apply(extract_complications)
-df_extracted = pd.concat([df_extracted, extracted], axis=1)
-
-# Extract sucesso
-extracted = df_extracted['conclusao'].apply(extract_sucesso)
-df_extracted = pd.concat([df_extracted, extracted], axis=1)
-
-
-# Prepare for evaluation
-df_extracted.rename(columns={'clean_text':'Conclusões',
-                             'Tronco_Comum_stent': 'Comprimento_Stents_mm_Tronco_Comum',
-                            'Descendente_Anterior_stent': 'Comprimento_Stents_mm_Descendente_Anterior',
-                            'Circunflexa_stent': 'Comprimento_Stents_mm_Circunflexa',
-                            'Coronária_Direita_stent': 'Comprimento_Stents_mm_Coronária_Direita',
-                            'Outras_artérias_stent': 'Comprimento_Stents_mm_Outras_artérias',
-
-                             },inplace=True)
-# columns_to_drop = ['angioplastia', 'conclusao']
-# for col in columns_to_drop:
-#     if col in df_extracted.columns:
-#         df_extracted.drop(columns=col,inplace=True)
-
-#Maybe no stents here? cretae column anyway with Nan
-if 'Comprimento_Stents_mm_Outras_artérias' not in df_extracted.columns:
-    df_extracted['Comprimento_Stents_mm_Outras_artérias'] = float('nan')
-
-
-# List of stent measurement columns and the corresponding count columns
-stent_cols = [
-    'Comprimento_Stents_mm_Tronco_Comum',
-    'Comprimento_Stents_mm_Circunflexa',
-    'Comprimento_Stents_mm_Coronária_Direita',
-    'Comprimento_Stents_mm_Descendente_Anterior',
-    'Comprimento_Stents_mm_Outras_artérias'
-]
-
-count_cols = [
-    'Nr_Stents_Tronco_Comum',
-    'Nr_Stents_Circunflexa',
-    'Nr_Stents_Coronária_Direita',
-    'Nr_Stents_Descendente_Anterior',
-    'Nr_Stents_Outras_artérias'
-]
-
-# Loop over each column
-for stent_col, count_col in zip(stent_cols, count_cols):
-    # If the column does not exist, create it filled with NaN
-    if stent_col not in df_extracted.columns:
-        df_extracted[stent_col] = float('nan')
-    
-    # Count the number of stents (split by ';'), handle NaN
-    df_extracted[count_col] = df_extracted[stent_col].apply(
-        lambda x: len(str(x).split(';')) if pd.notna(x) and str(x).strip() != '' else 0
-    )
+    return value
+
+
+def extract_sucesso(text):
+    return pd.Series({"Sucesso": sucesso_flag(text)})
+
+
+def columns_from_rows(rows):
+    """Turn per-report dicts into a dict of columns, with NaN where a report has no value.
+    Columns are in order of first appearance, like pd.concat of the per-report Series."""
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    return {name: [row.get(name, np.nan) for row in rows] for name in names}
+
+
+def batch_rows(texts, fn, args, cache=None, name=None):
+    """Apply a per-report extraction to a column of texts, through the extraction cache if given.
+    The regex 'model' is this source file and vocabulary.py, so editing the rules invalidates the cached results."""
+    if cache is None:
+        return [fn(text, *args) for text in texts]
+    model = source_fingerprint(__file__) + source_fingerprint(vocabulary.__file__)
+    variant = json.dumps([name, args])
+    return [cache.cached(lambda t: fn(t, *args), text, model, variant) for text in texts]
+
+
+def extract_vessel_measures_batch(texts, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure, cache=None):
+    args = (measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure)
+    return columns_from_rows(batch_rows(texts, vessel_measures, args, cache, "vessel_measures"))
+
+
+def extract_stent_measures_batch(texts, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure, cache=None):
+    args = (measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure)
+    return columns_from_rows(batch_rows(texts, stent_measures, args, cache, "stent_measures"))
+
+
+def extract_complications_batch(texts, accents_removed=False):
+    return {"Complicacoes": [complication_flag(text, accents_removed) for text in texts]}
+
+
+def extract_sucesso_batch(texts, accents_removed=False):
+    return {"Sucesso": [sucesso_flag(text, accents_removed) for text in texts]}
+
+
+def count_stents(values):
+    """Number of stents in each ';'-separated list of lengths, 0 for NaN or empty."""
+    return [len(str(x).split(';')) if pd.notna(x) and str(x).strip() != '' else 0 for x in values]
+
 
 final_variables = ["Conclusões",
-                    "Tipo",
-                    'Tronco_Comum_FFR', 'Descendente_Anterior_FFR', 'Circunflexa_FFR', 'Coronária_Direita_FFR', 'Outras_artérias_FFR',
-                    'Tronco_Comum_iFR', 'Descendente_Anterior_iFR', 'Circunflexa_iFR', 'Coronária_Direita_iFR', 'Outras_artérias_iFR',
+                    "Tipo"] + ffr_ifr_cols + [
                     'Complicacoes',
                     'Sucesso'] + stent_cols + count_cols
 
-df_extracted = df_extracted[final_variables]
 
-# Save extraction
-os.makedirs("results/ie_regex", exist_ok=True)
-df_extracted.to_csv('results/ie_regex/extraction_results.csv')
-df_extracted.to_excel('results/ie_regex/extraction_results.xlsx')
+def run_extraction(df, cache=None):
+    """Extract the variables from the 'Conclusões' column of df.
+    Every step works on whole columns and the result is built as a single DataFrame at the end."""
+    # Clean text
+    clean_text = [remove_accents(x) for x in df['Conclusões'].fillna('').astype(str)]
+
+    # Sections of each report
+    sections = split_sections_batch(clean_text, top_separators)
+    angioplastia = sections['ANGIOPLASTIA']
+    conclusao = sections['CONCLUSAO']
+
+    columns = {'Conclusões': clean_text}
+
+    # Extract FFR/iFR
+    columns.update(extract_vessel_measures_batch(
+        clean_text, measure_keywords, vessel_keywords, MAX_WORD_DISTANCE, default_measure, cache))
+
+    # Extract "tipo"
+    columns['Tipo'] = ['Coronariografia' if pd.isna(x) else 'Coronariografia e Angioplastia\t' for x in angioplastia]
+
+    # Extract stent measures
+    stents = extract_stent_measures_batch(
+        angioplastia, stent_keywords, vessel_keywords, STENT_MAX_WORD_DISTANCE, stent_default_measure, cache)
+    for name, values in stents.items():
+        columns[f'Comprimento_Stents_mm_{name.removesuffix("_stent")}'] = values
+
+    # Extract complications and sucesso (the sections are cut from the accent-free text)
+    columns.update(extract_complications_batch(clean_text, accents_removed=True))
+    columns.update(extract_sucesso_batch(conclusao, accents_removed=True))
+
+    # Columns not found in any report (e.g. no stents in other arteries) are created anyway with NaN
+    missing = [float('nan')] * len(clean_text)
+    for name in final_variables:
+        columns.setdefault(name, missing)
+
+    # Count the number of stents
+    for stent_col, count_col in zip(stent_cols, count_cols):
+        columns[count_col] = count_stents(columns[stent_col])
+
+    return pd.DataFrame({name: columns[name] for name in final_variables}, index=df.index)
+
+
+_worker_cache = None
+
+
+def _init_worker(cache_path):
+    # Each worker process opens its own connection to the shared cache
+    global _worker_cache
+    _worker_cache = ExtractionCache(cache_path) if cache_path else None
+
+
+def _extract_shard(shard):
+    if _worker_cache is None:
+        return run_extraction(shard), 0, 0
+    hits, misses = _worker_cache.hits, _worker_cache.misses
+    extracted = run_extraction(shard, _worker_cache)
+    # The pool never closes the workers' caches, so each shard writes its results
+    _worker_cache.flush()
+    return extracted, _worker_cache.hits - hits, _worker_cache.misses - misses
+
+
+def run_extraction_sharded(df, workers, shard_size=None, cache_path=None):
+    """run_extraction on a process pool. The input is split into shards of consecutive rows,
+    each shard is extracted in a worker and the results are concatenated back in input order.
+    Returns the results and the cache (hits, misses) of all the workers."""
+    if shard_size is None:
+        # A few shards per worker so a slow shard does not leave the other workers idle
+        shard_size = max(1, -(-len(df) // (workers * 4)))
+    shards = [df.iloc[start:start + shard_size] for start in range(0, len(df), shard_size)]
+    if cache_path:
+        # Create the cache tables before the workers open it
+        ExtractionCache(cache_path).close()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cache_path,)) as pool:
+        results = list(pool.map(_extract_shard, shards))
+
+    hits = sum(r[1] for r in results)
+    misses = sum(r[2] for r in results)
+    if not results:
+        return run_extraction(df), hits, misses
+    return pd.concat([r[0] for r in results]), hits, misses
+
+
+def run_extraction_streaming(input_path, output_path, chunksize=10000, cache=None):
+    """run_extraction over the input CSV read in chunks. Each chunk is appended to a Parquet file
+    (one row group per chunk), so memory does not grow with the corpus."""
+    n = 0
+    with TableWriter(output_path) as writer:
+        for chunk in pd.read_csv(input_path, index_col=0, chunksize=chunksize):
+            extracted = run_extraction(chunk, cache)
+            if cache is not None:
+                cache.flush()
+            writer.write(extracted.rename_axis(chunk.index.name or "index").reset_index())
+            n += len(chunk)
+    return n
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="number of processes (1 runs in this process)")
+    parser.add_argument("--shard-size", type=int, default=None, help="reports per shard when --workers > 1")
+    parser.add_argument("--stream", action="store_true", help="read the reports in chunks and append the results to the Parquet file")
+    parser.add_argument("--chunksize", type=int, default=10000, help="reports per chunk with --stream")
+    parser.add_argument("--export", nargs="*", default=[], choices=["csv", "xlsx"], help="also write the results as CSV/Excel")
+    parser.add_argument("--cache", action="store_true", help="reuse the results of unchanged reports from the extraction cache")
+    args = parser.parse_args()
+    output_path = 'results/ie_regex/extraction_results.parquet'
+
+    if args.stream:
+        # Constant memory: the reports are read and the results written one chunk at a time
+        cache = ExtractionCache() if args.cache else None
+        n = run_extraction_streaming('data/reports_groundtruth.csv', output_path, args.chunksize, cache)
+        print(f"Extracted {n} reports")
+        if cache is not None:
+            cache.close()
+            print(cache.stats())
+    else:
+        # Read data
+        df = pd.read_csv('data/reports_groundtruth.csv',index_col=0)
+
+        if args.workers > 1:
+            cache_path = "cache/extraction.sqlite" if args.cache else None
+            df_extracted, hits, misses = run_extraction_sharded(df, args.workers, args.shard_size, cache_path)
+            if args.cache:
+                print(f"Extraction cache: {hits} hits, {misses} misses")
+        else:
+            cache = ExtractionCache() if args.cache else None
+            df_extracted = run_extraction(df, cache)
+            if cache is not None:
+                cache.close()
+                print(cache.stats())
+
+        # Save extraction
+        write_table(df_extracted.rename_axis(df.index.name or "index").reset_index(), output_path)
+    if args.export:
+        export_table(output_path, args.export)
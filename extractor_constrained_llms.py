@@ -1,9 +1,14 @@
 """Extraction with constrained LLMs."""
 
-import json
+import argparse
 import pandas as pd
 from tqdm import tqdm
 import backbone_extractor_constrained_llms as extractor
+from extraction_cache import ExtractionCache
+from extraction_journal import JournalWriter, abort_requested, clear_abort, compact_journal, journaled_ids, read_journal
+from prefilter import has_candidates, null_extraction, trim_report
+import telemetry
+from worker_pool import ExtractorPool
 
 def safe_extract(x):
     try:
@@ -11,20 +16,147 @@ def safe_extract(x):
     except Exception:
         return None
 
+def safe_extract_timed(x):
+    try:
+        return extractor.extract_timed(str(x))
+    except Exception:
+        return None, None
+
+def extract_in_batches(misses, batch_size):
+    """Lists of (key, extracted, None) for the misses, batch_size reports at a time. A batch is only decoded
+    when the previous one has been consumed, so the run can stop between two batches."""
+    for start in range(0, len(misses), batch_size):
+        batch = misses[start:start + batch_size]
+        results = extractor.extract_many([report for _, report in batch], batch_size)
+        yield [(key, extracted, None) for (key, _), extracted in zip(batch, results)]
+
+def journal_record(id_, extracted, timing, with_telemetry):
+    if with_telemetry and timing:
+        return {"id": id_, "extracted": extracted, **timing}
+    return {"id": id_, "extracted": extracted}
+
 #RUN
-output_path = "results/<model_name_folder>/extraction.csv"
-checkpoint = 10
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="skip the reports already in the journal")
+    parser.add_argument("--prefilter", action="store_true", help="skip the LLM for reports without FFR/iFR candidate values")
+    parser.add_argument("--trim", action="store_true", help="send only the sentences with measure, vessel or stent keywords")
+    parser.add_argument("--telemetry", action="store_true", help="add per-report token and latency columns and write a latency summary")
+    parser.add_argument("--workers", type=int, default=1, help="extract in N processes sharing the memory-mapped model")
+    parser.add_argument("--batch-size", type=int, default=1, help="decode N reports at once as parallel sequences (no telemetry)")
+    parser.add_argument("--model", help="GGUF file (default: the model of the backbone)")
+    parser.add_argument("--quantization", help="quantisation of the backbone model to use, e.g. Q4_K_M")
+    parser.add_argument("--threads", type=int, help="llama.cpp threads")
+    parser.add_argument("--n-ctx", type=int, help="context size in tokens")
+    parser.add_argument("--n-batch", type=int, help="llama.cpp batch size of the prompt evaluation")
+    parser.add_argument("--specialise-schema", action="store_true",
+                        help="restrict the FFR/iFR fields of each report to the plausible numbers written in it")
+    args = parser.parse_args()
+
+    extractor.configure(model_path=args.model, quantization=args.quantization, n_threads=args.threads,
+                        n_ctx=args.n_ctx, n_batch=args.n_batch)
+    extractor.set_specialise(args.specialise_schema)
+
+    input_path = "data/reports_groundtruth.csv"
+    journal_path = "results/<model_name_folder>/extraction.jsonl"
+    output_path = "results/<model_name_folder>/extraction.parquet"
+    chunksize = 1000
+
+    done = journaled_ids(journal_path) if args.resume else set()
+    if done:
+        print(f"Resuming: {len(done)} reports already extracted.")
 
-schema_path = extractor.resource_path("output_schema.json")
-schema = json.load(open(schema_path, "r"))
+    # Results are reused when the report, model, few-shot prompt, context size (which decides how long reports
+    # are split into windows) and schema are unchanged. The model and the few-shot prompt are only built by the
+    # first extraction of this process, or in the workers
+    cache = ExtractionCache()
+    model_id = extractor.model_fingerprint(extractor.model_path)
+    variant = (f"{extractor.prompt_variant()}:n_ctx={extractor.N_CTX}:answer={extractor.ANSWER_TOKENS}"
+               f":overlap={extractor.CHUNK_OVERLAP}")
+    _, schema_digest = extractor.load_schema()
+    if args.specialise_schema:
+        schema_digest += ":specialised"
 
-df = pd.read_csv("data/reports_groundtruth.csv")
-df["extracted"] = None
+    # The workers load the same model and few-shot examples as this process
+    pool = None
+    if args.workers > 1:
+        pool = ExtractorPool(args.workers, {**extractor.settings(), "examples_path": extractor.examples_path,
+                                            "specialise_schema": args.specialise_schema})
 
-extractor.build_lm(schema)
+    # live_evaluation.py asks the run to stop by writing the abort file of the journal
+    clear_abort(journal_path)
+    aborted = None
+    routed = 0
+    with JournalWriter(journal_path, resume=args.resume) as journal:
+        for chunk in pd.read_csv(input_path, usecols=["id", "Conclusões"], chunksize=chunksize):
+            misses = []
+            for id_, x in tqdm(zip(chunk["id"].tolist(), chunk["Conclusões"]), total=len(chunk)):
+                aborted = abort_requested(journal_path)
+                if aborted:
+                    break
+                if id_ in done:
+                    continue
+                if args.prefilter and not has_candidates(x):
+                    # No FFR/iFR candidate: all-null record without calling the LLM
+                    journal.write({"id": id_, "extracted": null_extraction(x)})
+                    routed += 1
+                    continue
+                report = str(trim_report(x) if args.trim else x)
+                key = cache.key(report, model_id, variant, schema_digest)
+                extracted = cache.get(key)
+                if extracted is not None:
+                    journal.write(journal_record(id_, extracted, telemetry.cached_record(), args.telemetry))
+                elif pool is not None or args.batch_size > 1:
+                    misses.append(((id_, key), report))
+                else:
+                    if args.telemetry:
+                        extracted, timing = safe_extract_timed(report)
+                    else:
+                        extracted, timing = safe_extract(report), None
+                    cache.put(key, extracted)
+                    journal.write(journal_record(id_, extracted, timing, args.telemetry))
 
-for i, x in enumerate(tqdm(df["Conclusões"], total=len(df))):
-    df.at[i, "extracted"] = safe_extract(x)
+            # The reports of the chunk that are not in the cache are extracted by the workers or in batches
+            if aborted:
+                break
+            if not misses:
+                continue
+            if pool is not None:
+                batches = ([result] for result in pool.imap(misses))
+            else:
+                batches = extract_in_batches(misses, args.batch_size)
+            with tqdm(total=len(misses)) as progress:
+                for batch in batches:
+                    for (id_, key), extracted, timing in batch:
+                        cache.put(key, extracted)
+                        journal.write(journal_record(id_, extracted, timing, args.telemetry))
+                    progress.update(len(batch))
+                    aborted = abort_requested(journal_path)
+                    if aborted:
+                        break
+            if aborted:
+                break
+            cache.flush()
+    if pool is not None:
+        if aborted:
+            # The reports still queued in the workers are dropped
+            pool.terminate()
+        else:
+            pool.close()
+    if aborted:
+        print(f"Extraction aborted: {aborted}. Run with --resume to continue it.")
+    cache.close()
+    print(cache.stats())
+    if args.prefilter:
+        print(f"Pre-filter: {routed} reports routed around the LLM")
 
-    if (i + 1) % checkpoint == 0 or (i + 1) == len(df):
-        df.to_csv(output_path, index=False)
+    # Compact the journal into the tabular output
+    if args.telemetry:
+        compact_journal(journal_path, input_path, output_path, columns=["extracted"] + telemetry.TELEMETRY_COLS)
+        # Summary of the whole journal, so a resumed run covers the reports of the earlier runs too
+        records = [{col: r[col] for col in telemetry.TELEMETRY_COLS} if "latency_ms" in r else None
+                   for r in read_journal(journal_path)]
+        stats, summary_path = telemetry.write_summary(records, output_path)
+        print(f"{telemetry.describe(stats)} ({summary_path})")
+    else:
+        compact_journal(journal_path, input_path, output_path)
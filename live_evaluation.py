@@ -0,0 +1,121 @@
+"""Score a constrained LLM extraction while it is running.
+
+Follows the journal of extractor_constrained_llms.py, applies the postprocessing of the results (JSON
+normalisation, RegEx confirmation and optionally the implausible value filter) to the new records only and
+adds them to running confusion counts against the ground truth, so the earlier records are never scored again.
+When the presence/absence F1 or the value accuracy fall below a threshold after enough reports, it writes the
+abort file of the journal and the extraction stops at its next report (or batch):
+    python live_evaluation.py --min-f1 0.5 --min-value-accuracy 0.8 --min-reports 200
+"""
+
+import argparse
+import time
+import pandas as pd
+from evaluation import EvaluationCounts, columns
+from extraction_journal import JournalTail, request_abort
+from postprocessing_constrained import format_extractions
+from postprocessing_implausible import remove_implausible
+from postprocessing_regex import confirm_values
+from storage import read_table
+
+
+class LiveEvaluator:
+    """Running metrics of the journal records against the ground truth table (id, Conclusões and FFR/iFR)."""
+
+    def __init__(self, df_true, confirm=True, implausible=False):
+        self.df_true = df_true.set_index("id")[["Conclusões"] + columns]
+        self.confirm = confirm
+        self.implausible = implausible
+        self.reset()
+
+    def reset(self):
+        self.counts = EvaluationCounts()
+        self.seen = set()
+
+    def update(self, records):
+        """Add the new journal records (a report already scored is skipped). Returns the number of reports added."""
+        extracted = {}
+        for record in records:
+            if record["id"] not in self.seen and record["id"] in self.df_true.index:
+                extracted[record["id"]] = record.get("extracted")
+        if not extracted:
+            return 0
+        self.seen.update(extracted)
+
+        df_true = self.df_true.loc[list(extracted)]
+        df = pd.DataFrame({"id": list(extracted), "Conclusões": df_true["Conclusões"].to_numpy(),
+                           "extracted": list(extracted.values())})
+        df_pred = format_extractions(df).reindex(columns=columns)
+        df_pred.insert(0, "Conclusões", df["Conclusões"])
+        if self.confirm:
+            df_pred, _ = confirm_values(df_pred)
+        if self.implausible:
+            df_pred = remove_implausible(df_pred)
+        self.counts.update(df_true[columns], df_pred[columns])
+        return len(extracted)
+
+    def metrics(self):
+        return {"reports": len(self.seen), **self.counts.metrics()}
+
+
+def below_threshold(metrics, min_f1=None, min_value_accuracy=None, min_reports=200):
+    """Reason to abort the run, None while it is fine or has not scored min_reports reports yet."""
+    if metrics["reports"] < min_reports:
+        return None
+    if min_f1 is not None and metrics["f1"] < min_f1:
+        return f"F1 {metrics['f1']} < {min_f1} after {metrics['reports']} reports"
+    # NaN (no value extracted yet) compares False and does not abort
+    if min_value_accuracy is not None and metrics["value_accuracy"] < min_value_accuracy:
+        return f"value accuracy {metrics['value_accuracy']} < {min_value_accuracy} after {metrics['reports']} reports"
+    return None
+
+
+def describe(metrics):
+    return (f"{metrics['reports']} reports: F1 {metrics['f1']}, precision {metrics['precision']}, "
+            f"recall {metrics['recall']}, value accuracy {metrics['value_accuracy']}, "
+            f"out of format {metrics['out_of_format']}")
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--journal", default="results/<model_name_folder>/extraction.jsonl")
+    parser.add_argument("--true", default="data/reports_groundtruth.csv")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between reads of the journal")
+    parser.add_argument("--once", action="store_true", help="score the journal as it is and exit")
+    parser.add_argument("--no-confirm", action="store_true", help="skip the RegEx confirmation of the values")
+    parser.add_argument("--implausible", action="store_true", help="drop the values outside [0, 1.1]")
+    parser.add_argument("--min-f1", type=float, help="abort the extraction when the presence/absence F1 is lower")
+    parser.add_argument("--min-value-accuracy", type=float, help="abort the extraction when the value accuracy is lower")
+    parser.add_argument("--min-reports", type=int, default=200, help="reports to score before the thresholds apply")
+    args = parser.parse_args()
+
+    df_true = read_table(args.true, columns=["id", "Conclusões"] + columns, convert=False)
+    evaluator = LiveEvaluator(df_true, confirm=not args.no_confirm, implausible=args.implausible)
+    tail = JournalTail(args.journal)
+    restarts = 0
+    try:
+        while True:
+            records = tail.read_new()
+            if tail.restarts != restarts:
+                # A new run started the journal again
+                restarts = tail.restarts
+                evaluator.reset()
+            if evaluator.update(records):
+                metrics = evaluator.metrics()
+                print(describe(metrics), flush=True)
+                reason = below_threshold(metrics, args.min_f1, args.min_value_accuracy, args.min_reports)
+                if reason:
+                    request_abort(args.journal, reason)
+                    print(f"Abort requested: {reason}")
+                    break
+            if args.once and not records:
+                break
+            if len(evaluator.seen) == len(evaluator.df_true):
+                print("All the reports are scored.")
+                break
+            if not records:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    print(evaluator.metrics())
@@ -0,0 +1,155 @@
+"""Postprocessing and evaluation of an extraction in one process.
+
+Chains the steps of the reproducibility recipe as functions over DataFrames: JSON normalisation of the
+constrained outputs (postprocessing_constrained), implausible value filter (postprocessing_implausible),
+RegEx confirmation (postprocessing_regex) and evaluation against the ground truth. The output of each stage
+is cached under a hash of its input tables and the source of its code, so changing a stage (or the
+extraction) only recomputes that stage and the ones after it:
+    python pipeline.py --input results/<model_name_folder>/extraction.parquet --implausible
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pandas as pd
+import vocabulary
+from evaluation import evaluate_FFR_iFR
+from extraction_cache import source_fingerprint
+from postprocessing_constrained import format_extractions
+from postprocessing_implausible import remove_implausible
+from postprocessing_regex import confirm_values
+from storage import ffr_ifr_cols, read_table, typed, write_table
+
+
+def normalise(df):
+    """One column per field of the JSON in 'extracted', keeping Conclusões for the confirmation."""
+    df_pred = format_extractions(df)
+    # A field that no answer has (e.g. all the answers truncated before it) still gets its column
+    for col in ffr_ifr_cols:
+        if col not in df_pred.columns:
+            df_pred[col] = None
+    df_pred.insert(0, "Conclusões", df["Conclusões"].to_numpy())
+    if "id" in df.columns:
+        df_pred.insert(0, "id", df["id"].to_numpy())
+    return df_pred
+
+
+def implausible(df):
+    df = df.copy()
+    df[ffr_ifr_cols] = remove_implausible(df[["Conclusões"] + ffr_ifr_cols])[ffr_ifr_cols].to_numpy()
+    return df
+
+
+def confirm(df):
+    return confirm_values(df)[0]
+
+
+def evaluate(df_pred, df_true):
+    return evaluate_FFR_iFR(df_true, df_pred, verbose=False)
+
+
+# Stage name -> (function, wrapped postprocessing function). The cache key includes the source of both modules
+STAGES = {
+    "normalise": (normalise, format_extractions),
+    "implausible": (implausible, remove_implausible),
+    "confirm": (confirm, confirm_values),
+    "evaluate": (evaluate, evaluate_FFR_iFR),
+}
+
+# Code that every stage output depends on: this module, and the storage layer that types the cached tables
+SHARED_SOURCES = [os.path.abspath(__file__), inspect.getsourcefile(typed), inspect.getsourcefile(vocabulary)]
+
+
+def frame_hash(df):
+    """Hash of the columns and values of a table."""
+    h = hashlib.sha256(json.dumps(list(map(str, df.columns)), ensure_ascii=False).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df.astype(object), index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+class StageCache:
+    """Outputs of the pipeline stages on disk (tables as Parquet, metrics as JSON), keyed by stage and input."""
+
+    def __init__(self, path="cache/pipeline"):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(name, input_hashes):
+        """Hash of the stage, the source of its code (and of SHARED_SOURCES) and the hashes of its input tables."""
+        sources = [source_fingerprint(inspect.getsourcefile(fn)) for fn in STAGES[name]]
+        sources += [source_fingerprint(path) for path in SHARED_SOURCES]
+        payload = json.dumps([name, sources, input_hashes])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def run(self, name, *inputs, input_hashes=None):
+        """Output of the stage on the input tables, from the cache or computed and stored on a miss, and its key.
+        The key identifies the output, so it is the input hash of the next stage and only the tables that do
+        not come from a stage need to be hashed."""
+        key = self.key(name, input_hashes or [frame_hash(df) for df in inputs])
+        path = os.path.join(self.path, f"{name}_{key}")
+        if os.path.exists(path + ".parquet"):
+            self.hits += 1
+            return read_table(path + ".parquet"), key
+        if os.path.exists(path + ".json"):
+            self.hits += 1
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                return json.load(f), key
+        self.misses += 1
+        out = STAGES[name][0](*inputs)
+        if isinstance(out, pd.DataFrame):
+            # Typed as if the stage had written its output to Parquet, so a hit gives the same table
+            out = typed(out)
+            write_table(out, path + ".parquet")
+        else:
+            with open(path + ".json", "w", encoding="utf-8") as f:
+                json.dump(out, f)
+        return out, key
+
+    def stats(self):
+        return f"Pipeline cache: {self.hits} hits, {self.misses} misses"
+
+
+def run_pipeline(df, df_true=None, use_implausible=False, use_confirm=True, cache=None):
+    """Postprocess an extraction table (with an 'extracted' JSON column or one column per FFR/iFR value)
+    and evaluate it against df_true when given. Returns the postprocessed table and the metrics (None without df_true)."""
+    cache = cache or StageCache()
+    h = frame_hash(df)
+    if "extracted" in df.columns:
+        df, h = cache.run("normalise", df, input_hashes=[h])
+    if use_implausible:
+        df, h = cache.run("implausible", df, input_hashes=[h])
+    if use_confirm:
+        df, h = cache.run("confirm", df, input_hashes=[h])
+    metrics = None
+    if df_true is not None:
+        df_true = df_true[ffr_ifr_cols]
+        metrics, _ = cache.run("evaluate", df, df_true, input_hashes=[h, frame_hash(df_true)])
+    return df, metrics
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="results/<model_name_folder>/extraction.parquet")
+    parser.add_argument("--true", default="data/reports_groundtruth.csv")
+    parser.add_argument("--output", help="postprocessed table (default: extraction_results.parquet next to the input)")
+    parser.add_argument("--implausible", action="store_true", help="drop the values outside [0, 1.1]")
+    parser.add_argument("--no-confirm", action="store_true", help="skip the RegEx confirmation")
+    parser.add_argument("--export", nargs="*", default=[], choices=["csv", "xlsx"], help="also write the table as CSV/Excel")
+    parser.add_argument("--cache-dir", default="cache/pipeline")
+    args = parser.parse_args()
+
+    df = read_table(args.input)
+    df_true = read_table(args.true, columns=ffr_ifr_cols, convert=False)
+    cache = StageCache(args.cache_dir)
+    df_pred, metrics = run_pipeline(df, df_true, args.implausible, not args.no_confirm, cache)
+
+    output = args.output or os.path.join(os.path.dirname(args.input), "extraction_results.parquet")
+    write_table(df_pred, output, export=args.export)
+    print(cache.stats())
+    print(metrics)
@@ -3,6 +3,7 @@
 import pandas as pd
 import json
 import numpy as np
+from storage import read_table, write_table
 
 
 def safe_json_load(x):
@@ -20,12 +21,22 @@ def safe_json_load(x):
         return np.nan
 
 
-model_folder = "<model_name_folder>" 
-df = pd.read_excel(f"results/{model_folder}/extraction.xlsx")
-df = df[['id', 'Conclusões','extracted']]
+def format_extractions(df):
+    """One column per extracted field from the JSON in the 'extracted' column."""
+    df = df[['id', 'Conclusões','extracted']]
 
-df_json = df['extracted'].apply(safe_json_load)
-df_final = pd.json_normalize(df_json)
+    df_json = df['extracted'].apply(safe_json_load)
+    return pd.json_normalize(df_json)
+
+
+#RUN
+if __name__ == "__main__":
+    model_folder = "<model_name_folder>" 
+    df = read_table(f"results/{model_folder}/extraction.parquet")
+
+    df_final = format_extractions(df)
+
+    # Conclusões is kept for the RegEx confirmation (postprocessing_regex.py)
+    df_final.insert(0, "Conclusões", df["Conclusões"].to_numpy())
+    write_table(df_final, f"results/{model_folder}/extraction_results.parquet")
 
-# Save the result to a new Excel file
-df_final.to_excel(f"results/{model_folder}/extraction_results.xlsx", index=False)
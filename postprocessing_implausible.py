@@ -2,14 +2,24 @@
 
 import pandas as pd
 import numpy as np
+from storage import read_table, write_table
 
-path = 'results/<model_name_folder>/extraction_results.xlsx'
-df_pred = pd.read_csv(path)
 
-df_numeric = df_pred.apply(pd.to_numeric, errors='coerce')
+def remove_implausible(df_pred):
+    """Keep only the numeric values in [0, 1.1], else NaN. Conclusões is kept as is."""
+    df_numeric = df_pred.apply(pd.to_numeric, errors='coerce')
 
-# Keep only values in [0,1], else NaN
-df = df_numeric.where((df_numeric >= 0) & (df_numeric <= 1.1))
-df["Conclusões"] = df_pred["Conclusões"].values
+    # Keep only values in [0,1], else NaN
+    df = df_numeric.where((df_numeric >= 0) & (df_numeric <= 1.1))
+    df["Conclusões"] = df_pred["Conclusões"].values
+    return df
 
-df.to_excel(path, index=False)
\ No newline at end of file
+
+#RUN
+if __name__ == "__main__":
+    path = 'results/<model_name_folder>/extraction_results.parquet'
+    df_pred = read_table(path)
+
+    df = remove_implausible(df_pred)
+
+    write_table(df, path)
@@ -6,8 +6,12 @@ import pandas as pd
 import numpy as np
 import re
 import os 
+from storage import ffr_ifr_cols, read_table, write_table
 
 
+NUMBER_PATTERN = r'\d+[.,]?\d*'
+NUMBER_RE = re.compile(NUMBER_PATTERN)
+
 def value_in_conclusoes(text, val):
     #If no value is present, skip verification
     if pd.isna(val):
@@ -20,55 +24,69 @@ def value_in_conclusoes(text, val):
         return False
 
     # Extract all numbers from text
-    numbers_in_text = re.findall(r'\d+[.,]?\d*', str(text))
+    numbers_in_text = re.findall(NUMBER_PATTERN, str(text))
     numbers_in_text = [float(n.replace(',', '.')) for n in numbers_in_text]
 
     # Check if val is exactly in numbers_in_text
-    is_there = val in numbers_in_text
-    
-    #If not present, print to analyse what is happening
-    if is_there == False:
-        print(text)
-        print(numbers_in_text)
-        print(val)
+    return val in numbers_in_text
 
-    return is_there
 
+def numbers_in(text):
+    """Set of the numbers in a report."""
+    return {float(n.replace(',', '.')) for n in NUMBER_RE.findall(str(text))}
 
-#Folders
-results_folder = f"results/<model_name_folder>"
-output_folder = f"{results_folder}_confirmed"
 
-#Create a output folder for the results after RegEx confirmation
-if not os.path.exists(f"{output_folder}"):
-    os.makedirs(f"{output_folder}")
-else:
-    print(f"Folder {output_folder} already exists. Results may be overwritten.")
-    
-#Load the results from LLM extraction
-if os.path.exists(f"{results_folder}/extraction_results.xlsx"):
-    df = pd.read_excel(f"{results_folder}/extraction_results.xlsx")
-
-
-#Columns to confirm
-ffr_ifr_cols = [
-    'Tronco_Comum_FFR',
-    'Descendente_Anterior_FFR',
-    'Circunflexa_FFR',
-    'Coronária_Direita_FFR',
-    'Outras_artérias_FFR',
-    'Tronco_Comum_iFR',
-    'Descendente_Anterior_iFR',
-    'Circunflexa_iFR',
-    'Coronária_Direita_iFR',
-    'Outras_artérias_iFR'
-]
-
-df_filtered = df.copy()
-    
-for col in ffr_ifr_cols:
-    df_filtered[col] = df_filtered.apply(
-        lambda row: row[col] if value_in_conclusoes(row['Conclusões'], row[col]) else np.nan,
-        axis=1)
+def confirm_values(df, cols=ffr_ifr_cols, text_col='Conclusões'):
+    """Keep the values of cols that are among the numbers of the report and replace the others with NaN.
+    Each report is tokenised once and all the columns are checked against its set of numbers.
+    Returns the confirmed table and the misses (one row per value not found in its report)."""
+    values = df[cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+    # Only the extracted values (not NaN) need to be checked, and only their reports tokenised
+    rows, col_idx = np.nonzero(~np.isnan(values))
+    texts = df[text_col].to_numpy()
+    numbers = {r: numbers_in(texts[r]) for r in np.unique(rows).tolist()}
+    extracted = values[rows, col_idx]
+    found = np.fromiter((v in numbers[r] for r, v in zip(rows.tolist(), extracted.tolist())), dtype=bool, count=len(rows))
+
+    confirmed = np.zeros(values.shape, dtype=bool)
+    confirmed[rows[found], col_idx[found]] = True
+    df_filtered = df.copy()
+    df_filtered[cols] = df[cols].where(confirmed).infer_objects()
+
+    # Diagnostics of the values that are not in the report
+    missed = ~found
+    misses = pd.DataFrame({
+        'row': rows[missed],
+        'column': np.asarray(cols, dtype=object)[col_idx[missed]],
+        'value': extracted[missed],
+        'numbers_in_text': ['; '.join(map(str, sorted(numbers[r]))) for r in rows[missed].tolist()],
+        text_col: texts[rows[missed]],
+    })
+    if 'id' in df.columns:
+        misses.insert(1, 'id', df['id'].to_numpy()[rows[missed]])
+    return df_filtered, misses
+
+
+#RUN
+if __name__ == "__main__":
+    #Folders
+    results_folder = f"results/<model_name_folder>"
+    output_folder = f"{results_folder}_confirmed"
+
+    #Create a output folder for the results after RegEx confirmation
+    if not os.path.exists(f"{output_folder}"):
+        os.makedirs(f"{output_folder}")
+    else:
+        print(f"Folder {output_folder} already exists. Results may be overwritten.")
+
+    #Load the results from LLM extraction
+    df = read_table(f"{results_folder}/extraction_results.parquet")
+
+    df_filtered, misses = confirm_values(df)
+
+    #Values not found in the text are written to a file to analyse what is happening
+    misses.to_csv(f"{output_folder}/confirmation_misses.csv", index=False)
+    print(f"{len(misses)} values not found in the text (see {output_folder}/confirmation_misses.csv)")
 
-df_filtered.to_excel(f"{output_folder}/extraction_results.xlsx", index=False)
\ No newline at end of file
+    write_table(df_filtered, f"{output_folder}/extraction_results.parquet")
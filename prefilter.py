@@ -0,0 +1,114 @@
+"""Regex pre-filter in front of the LLM extractors.
+
+Most reports contain no FFR/iFR at all. A report can only hold one if it has a number like 0.XX
+(the num pattern of the regex baseline) and mentions a measure (FFR or iFR), so the reports without
+both are given an all-null record directly instead of being sent to the model.
+
+The reports that do go to the model can also be trimmed to the sentences that mention a measure,
+a vessel or a stent, which shortens the prompt.
+"""
+
+import json
+import re
+import pandas as pd
+from vocabulary import (ffr_ifr_num_pattern, measure_keywords, vessel_keywords, stent_keywords,
+                        top_separators, ffr_ifr_cols, remove_accents)
+
+num_re = re.compile(ffr_ifr_num_pattern)
+# Case insensitive, unlike the regex baseline, so 'ffr' or 'Ifr' still go to the LLM
+measure_re = re.compile('|'.join(re.escape(k) for k in measure_keywords), re.IGNORECASE)
+
+
+def has_candidates(text):
+    """True if the report may contain a FFR/iFR value."""
+    if not isinstance(text, str):
+        return False
+    return num_re.search(text) is not None and measure_re.search(text) is not None
+
+
+def procedure_type(text):
+    """Tipo of the report, as in the regex baseline: angioplastia if the report has an ANGIOPLASTIA section."""
+    if isinstance(text, str) and 'ANGIOPLASTIA' in remove_accents(text):
+        return "Coronariografia e Angioplastia"
+    return "Coronariografia"
+
+
+def null_extraction(text):
+    """All-null record in the format of the constrained extractor (output_schema.json)."""
+    record = {"Tipo": procedure_type(text)}
+    record.update({col: None for col in ffr_ifr_cols})
+    return json.dumps(record, ensure_ascii=False)
+
+
+# Sentences kept by trim_report: a measure, a vessel or a stent keyword of the regex baseline, or a candidate value
+trim_keywords = [remove_accents(k).lower()
+                 for k in measure_keywords + [v for keys in vessel_keywords.values() for v in keys] + stent_keywords]
+trim_re = re.compile('|'.join(re.escape(k) for k in trim_keywords) + '|' + ffr_ifr_num_pattern)
+section_re = re.compile('|'.join(re.escape(sep) for sep in top_separators))
+sentence_re = re.compile(r'(?<=[.;])\s+|\n+')
+
+
+def fold(text):
+    """Accent-free text with the same length as text, so positions in it are positions in text."""
+    if text.isascii():
+        return text
+    return ''.join((remove_accents(c) or c)[0] for c in text)
+
+
+def trim_report(text):
+    """Keep only the sentences of the report that mention a measure, a vessel, a stent or a candidate value,
+    each under the header of its section. The ANGIOPLASTIA header is always kept, as the model uses it for Tipo.
+    Returns the report unchanged if nothing would be kept."""
+    if not isinstance(text, str):
+        return text
+    folded = fold(text)
+    # Sections start at each header; the text before the first header is a section without header
+    starts = [0] + [m.start() for m in section_re.finditer(folded)] + [len(text)]
+    kept = []
+    for start, end in zip(starts, starts[1:]):
+        header = section_re.match(folded, start, end)
+        body_start = header.end() if header else start
+        sentences = [s.strip() for s in sentence_re.split(text[body_start:end])
+                     if trim_re.search(fold(s).lower())]
+        if sentences or (header and header.group() == 'ANGIOPLASTIA'):
+            kept.append(' '.join(([text[start:body_start]] if header else []) + sentences))
+    trimmed = '\n'.join(kept)
+    return trimmed if trimmed.strip() else text
+
+
+def approx_tokens(text):
+    """Rough token count (words and punctuation) to compare prompt lengths without loading a tokenizer."""
+    return len(re.findall(r'\w+|[^\w\s]', str(text)))
+
+
+def trim_stats(texts):
+    """Average length of the reports before and after trim_report."""
+    full = [approx_tokens(t) for t in texts]
+    trimmed = [approx_tokens(trim_report(t)) for t in texts]
+    before, after = sum(full) / max(len(full), 1), sum(trimmed) / max(len(trimmed), 1)
+    return {"tokens_full": before, "tokens_trimmed": after, "reduction": 1 - after / before if before else 0.0}
+
+
+def prefilter_stats(df, text_col="Conclusões", cols=ffr_ifr_cols):
+    """Number of reports routed around the LLM and, when df has the ground truth columns,
+    how many ground truth values are in those reports (the recall cost of the pre-filter)."""
+    candidates = df[text_col].map(has_candidates)
+    stats = {"reports": len(df), "routed": int((~candidates).sum())}
+    if all(col in df.columns for col in cols):
+        present = df[cols].notna()
+        stats["values"] = int(present.values.sum())
+        stats["values_lost"] = int(present[~candidates].values.sum())
+        stats["recall_cost"] = stats["values_lost"] / stats["values"] if stats["values"] else 0.0
+    return stats
+
+
+#RUN
+if __name__ == "__main__":
+    df_true = pd.read_csv('data/reports_groundtruth.csv')
+    stats = prefilter_stats(df_true)
+    print(f"Routed around the LLM: {stats['routed']} of {stats['reports']} reports")
+    print(f"Ground truth values in routed reports: {stats['values_lost']} of {stats['values']} "
+          f"(recall cost {stats['recall_cost']:.2%})")
+    stats = trim_stats(df_true["Conclusões"])
+    print(f"Trimmed reports: {stats['tokens_trimmed']:.0f} vs {stats['tokens_full']:.0f} tokens on average "
+          f"({stats['reduction']:.1%} shorter)")
@@ -0,0 +1,147 @@
+"""Storage of the pipeline tables (extractions, postprocessed results, predictions) as typed Parquet files.
+
+Every script reads and writes its intermediates through read_table/write_table, so the columns have the same
+types whatever the step that wrote them: the ten FFR/iFR columns are strings as the extractor wrote them (a
+number, "0,85" or "0.7 (DA)"), so their format is still judged by the evaluation, the stent fields are
+strings and the counts integers.
+CSV and Excel are only written as a final export (write_table(..., export=["xlsx"]) or
+python storage.py results/<model_name_folder>/extraction_results.parquet --to xlsx csv).
+"""
+
+import argparse
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from vocabulary import count_cols, ffr_ifr_cols, stent_cols
+
+# Arrow type of the known columns; the others keep the type pandas infers
+DTYPES = {
+    "id": pa.int64(),
+    "Conclusões": pa.string(),
+    "Tipo": pa.string(),
+    "extracted": pa.string(),
+    "Complicacoes": pa.int64(),
+    "Sucesso": pa.int64(),
+    **{c: pa.string() for c in ffr_ifr_cols},
+    **{c: pa.string() for c in stent_cols},
+    **{c: pa.int64() for c in count_cols},
+}
+
+EXPORT_FORMATS = ("csv", "xlsx")
+
+
+def typed(df):
+    """df with the known columns converted to their types. Values are not parsed on the way: a number in a
+    string column is stored as its text, and text stays as it is."""
+    df = df.copy()
+    for col in df.columns:
+        dtype = DTYPES.get(col)
+        if dtype == pa.int64():
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        elif dtype == pa.string():
+            df[col] = df[col].astype("string")
+    return df
+
+
+def arrow_schema(df, preserve_index=False):
+    """Arrow schema of df: DTYPES for the known columns, the inferred type for the others (string when a
+    column is all missing, so that later chunks can fill it)."""
+    inferred = pa.Schema.from_pandas(df, preserve_index=preserve_index)
+    fields = []
+    for field in inferred:
+        dtype = DTYPES.get(field.name, field.type)
+        fields.append(pa.field(field.name, pa.string() if pa.types.is_null(dtype) else dtype))
+    return pa.schema(fields)
+
+
+def to_arrow(df, schema=None, preserve_index=False):
+    df = typed(df)
+    return pa.Table.from_pandas(df, schema=schema or arrow_schema(df, preserve_index), preserve_index=preserve_index)
+
+
+class TableWriter:
+    """Append DataFrame chunks to one Parquet file (one row group per chunk). The schema is set by the first chunk."""
+
+    def __init__(self, path, preserve_index=False):
+        self.path = path
+        self.preserve_index = preserve_index
+        self.writer = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, df):
+        df = typed(df)
+        if self.writer is None:
+            self.schema = arrow_schema(df, self.preserve_index)
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=self.preserve_index))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_table(df, path, export=(), preserve_index=False):
+    """Write df to the Parquet file path, and to CSV/Excel files next to it for the formats in export."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    pq.write_table(to_arrow(df, preserve_index=preserve_index), path)
+    if export:
+        export_table(path, export)
+
+
+def read_table(path, columns=None, convert=True):
+    """Table of a Parquet file, or of a CSV/Excel file (inputs and older results) converted to the same
+    column types unless convert is False."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return pq.read_table(path, columns=columns).to_pandas()
+    df = pd.read_excel(path, usecols=columns) if ext in (".xlsx", ".xls") else pd.read_csv(path, usecols=columns)
+    return typed(df) if convert else df
+
+
+def iter_batches(path, columns=None, chunksize=100000, convert=True):
+    """Tables of chunksize rows of a Parquet or CSV file (Excel files are read at once)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    elif ext in (".xlsx", ".xls"):
+        yield read_table(path, columns, convert)
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield typed(chunk) if convert else chunk
+
+
+def export_table(path, formats=EXPORT_FORMATS):
+    """Write CSV and/or Excel copies of a Parquet table next to it. Returns their paths.
+    The CSV is written in chunks, Excel needs the whole table."""
+    paths = []
+    for fmt in formats:
+        out = os.path.splitext(path)[0] + "." + fmt
+        if fmt == "csv":
+            for i, chunk in enumerate(iter_batches(path)):
+                chunk.to_csv(out, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        elif fmt == "xlsx":
+            read_table(path).to_excel(out, index=False)
+        else:
+            raise ValueError(f"Unknown export format {fmt!r} (one of {', '.join(EXPORT_FORMATS)})")
+        paths.append(out)
+    return paths
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="Parquet tables to export")
+    parser.add_argument("--to", nargs="+", default=["xlsx"], choices=EXPORT_FORMATS)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        for out in export_table(path, args.to):
+            print(f"Written {out}")
@@ -0,0 +1,119 @@
+"""Generate synthetic Portuguese CAG reports with their FFR/iFR ground truth.
+
+The real reports can not leave the hospital, so performance regressions are reproduced on synthetic ones.
+They are built from what the regex baseline knows: the section headers (top_separators), the vessel names
+(vessel_keywords), the measures (measure_keywords) written as 0.XX or 0,XX (ffr_ifr_num_pattern) and stents.
+The table has the same columns as data/reports_groundtruth.csv for the FFR/iFR values.
+"""
+
+import argparse
+import random
+import numpy as np
+import pandas as pd
+from vocabulary import vessel_keywords, measure_keywords, ffr_ifr_cols
+
+# Vessel names as written in the reports (the keywords of the regex baseline are accent free)
+accented = {'Coronaria Direita': 'Coronária Direita', 'Ramo Intermedio': 'Ramo Intermédio'}
+vessel_names = {artery.replace(' ', '_'): [accented.get(k, k) for k in keywords]
+                for artery, keywords in vessel_keywords.items()}
+
+measure_names = {'FFR': ['FFR', 'ffr', 'reserva fracional de fluxo (FFR)'],
+                 'iFR': ['iFR', 'IFR', 'instantaneous wave-free ratio (iFR)']}
+
+filler = [
+    "Pressão arterial sistémica normal.",
+    "Pressão telediastólica ventricular esquerda não avaliada.",
+    "Acesso radial direito 6F.",
+    "Cateterismo efectuado pela ARF - 6Fr.",
+    "Pressão aórtica {sys}/{dia} mmHg.",
+    "Administrados {dose} mg de nitratos intracoronários.",
+    "Heparina {ui} UI.",
+    "Dominância direita.",
+    "Doente estável durante o procedimento.",
+]
+
+lesions = [
+    "{vessel} sem lesões significativas.",
+    "{vessel} com lesão de {pct}% no segmento proximal.",
+    "{vessel} com doença difusa, sem lesões graves.",
+    "Estenose moderada da {vessel_lower}.",
+    "{vessel} com excelente resultado da intervenção anterior.",
+]
+
+physiology = [
+    "Avaliação funcional da {vessel_lower} com PressureWire ({measure} de {value}).",
+    "Foi efectuado {measure} da {vessel_lower} que mostrou {value}.",
+    "{vessel}: {measure} = {value}.",
+]
+
+conclusions = ["Bom resultado final.", "Doença coronária de um vaso.", "Sem doença coronária significativa.",
+               "Angioplastia com sucesso."]
+
+
+def fill(template, rng, vessel="", **values):
+    return template.format(vessel=vessel, vessel_lower=vessel.lower(), pct=rng.randint(30, 95),
+                           sys=rng.randint(100, 160), dia=rng.randint(50, 90), dose=rng.choice(["0.2", "0,5", "1"]),
+                           ui=rng.choice([5000, 7000, 10000]), **values)
+
+
+def make_report(rng, n_sentences, p_physiology=0.2, p_angioplasty=0.4, p_comma=0.3):
+    """One report of about n_sentences sentences and its FFR/iFR values (the lowest when a vessel has several)."""
+    truth = {}
+    body = [fill(rng.choice(filler), rng) for _ in range(max(1, n_sentences // 3))]
+    for artery in rng.sample(list(vessel_names), rng.randint(1, 4)):
+        body.append(fill(rng.choice(lesions), rng, rng.choice(vessel_names[artery])))
+
+    if rng.random() < p_physiology:
+        for artery in rng.sample(list(vessel_names), rng.randint(1, 2)):
+            measure = rng.choice(measure_keywords)
+            vessel = rng.choice(vessel_names[artery])
+            for _ in range(rng.choice([1, 1, 1, 2])):
+                value = round(rng.uniform(0.60, 0.99), 2)
+                text = f"{value:.2f}".replace('.', ',') if rng.random() < p_comma else f"{value:.2f}"
+                body.append(fill(rng.choice(physiology), rng, vessel, measure=rng.choice(measure_names[measure]),
+                                 value=text))
+                col = f"{artery}_{measure}"
+                truth[col] = min(truth.get(col, value), value)
+    # Pad to the target length with more description of the procedure
+    while len(body) < n_sentences:
+        body.append(fill(rng.choice(filler + lesions), rng, rng.choice(rng.choice(list(vessel_names.values())))))
+
+    sections = ["CORONARIOGRAFIA:", "\n".join(body), "VENTRICULOGRAFIA:", "Não efectuada."]
+    if rng.random() < p_angioplasty:
+        vessel = rng.choice(rng.choice(list(vessel_names.values()))).lower()
+        sections += ["ANGIOPLASTIA:",
+                     f"Angioplastia da {vessel} com implantação de stent XIENCE {rng.choice(['2,5', '2,75', '3,0', '3,5'])} "
+                     f"x {rng.randint(8, 38)} mm a {rng.randint(10, 18)} ATM com bom resultado final.",
+                     rng.choice(["Sem complicações.", "Sem complicações.", "Complicação: dissecção coronária."])]
+    sections += ["CONCLUSÃO:", rng.choice(conclusions)]
+    if rng.random() < 0.1:
+        sections += ["NOTA:", "Doente orientado para consulta de cardiologia."]
+    return "\n".join(sections), truth
+
+
+def generate(n, seed=0, mean_sentences=8, length_sigma=0.5, p_physiology=0.2, p_angioplasty=0.4):
+    """Table of n reports with the id, Conclusões and FFR/iFR ground truth columns.
+    Report lengths follow a lognormal distribution around mean_sentences sentences."""
+    rng = random.Random(seed)
+    lengths = np.random.default_rng(seed).lognormal(np.log(mean_sentences), length_sigma, n).round().astype(int)
+    rows = []
+    for i, n_sentences in enumerate(lengths):
+        text, truth = make_report(rng, int(n_sentences), p_physiology, p_angioplasty)
+        rows.append({"id": i, "Conclusões": text, **truth})
+    return pd.DataFrame(rows).reindex(columns=["id", "Conclusões"] + ffr_ifr_cols)
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=1000, help="number of reports")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mean-sentences", type=int, default=8, help="median report length in sentences")
+    parser.add_argument("--length-sigma", type=float, default=0.5, help="spread of the lognormal report length")
+    parser.add_argument("--p-physiology", type=float, default=0.2, help="share of reports with FFR/iFR values")
+    parser.add_argument("--output", default="data/synthetic_reports.csv")
+    args = parser.parse_args()
+
+    df = generate(args.n, args.seed, args.mean_sentences, args.length_sigma, args.p_physiology)
+    df.to_csv(args.output, index=False)
+    print(f"{len(df)} reports written to {args.output}, {df[ffr_ifr_cols].notna().any(axis=1).sum()} with FFR/iFR values")
@@ -0,0 +1,86 @@
+"""Per-report latency and token telemetry of the LLM extractors.
+
+Each report sent to a LLM gets a record with its prompt and generated tokens, the prefill and decode time
+and the decode speed, taken from the Ollama response metadata (baseline LLMs) or from the llama.cpp
+performance counters (constrained LLMs). The run summary has the p50/p95/p99 of each of them.
+"""
+
+import json
+import os
+import numpy as np
+
+TELEMETRY_COLS = ["prompt_tokens", "generated_tokens", "prefill_ms", "decode_ms", "tokens_per_s", "latency_ms",
+                  "cached"]
+PERCENTILES = [50, 95, 99]
+
+
+def record(prompt_tokens, generated_tokens, prefill_ms, decode_ms, latency_ms):
+    """Telemetry of one report. tokens_per_s is the decode speed."""
+    tokens_per_s = generated_tokens / decode_ms * 1000 if generated_tokens is not None and decode_ms else None
+    return {"prompt_tokens": prompt_tokens, "generated_tokens": generated_tokens, "prefill_ms": prefill_ms,
+            "decode_ms": decode_ms, "tokens_per_s": tokens_per_s, "latency_ms": latency_ms, "cached": False}
+
+
+def from_ollama(info, latency_ms):
+    """Record of an Ollama response from its generation_info (durations in ns). Missing fields are None."""
+    info = info or {}
+
+    def ms(key):
+        return info[key] / 1e6 if info.get(key) is not None else None
+
+    return record(info.get("prompt_eval_count"), info.get("eval_count"), ms("prompt_eval_duration"),
+                  ms("eval_duration"), latency_ms)
+
+
+def from_llama_cpp(perf, latency_ms):
+    """Record of the llama.cpp context counters (llama_perf_context) since their last reset.
+    llama.cpp counts the batches of more than one token as prompt evaluation and the single tokens as decode."""
+    return record(perf.n_p_eval, perf.n_eval, perf.t_p_eval_ms, perf.t_eval_ms, latency_ms)
+
+
+def cached_record():
+    """Record of a report answered by the extraction cache, without any LLM call."""
+    values = {col: None for col in TELEMETRY_COLS}
+    values["cached"] = True
+    return values
+
+
+def summary(records):
+    """Run-level summary of the records (None for the reports that did not go to the LLM):
+    counts, total tokens and the p50/p95/p99 of the timings and token counts of the LLM calls."""
+    records = list(records)
+    calls = [r for r in records if r and not r.get("cached")]
+    stats = {"reports": len(records),
+             "llm_calls": len(calls),
+             "cached": sum(1 for r in records if r and r.get("cached")),
+             "skipped": sum(1 for r in records if not r)}
+    for col in ["prompt_tokens", "generated_tokens"]:
+        stats[f"total_{col}"] = int(sum(r[col] or 0 for r in calls))
+    for col in ["latency_ms", "prefill_ms", "decode_ms", "tokens_per_s", "prompt_tokens", "generated_tokens"]:
+        values = np.array([r[col] for r in calls if r.get(col) is not None], dtype=float)
+        for p in PERCENTILES:
+            stats[f"{col}_p{p}"] = float(np.percentile(values, p)) if len(values) else None
+    return stats
+
+
+def describe(stats):
+    """One line with the latency percentiles of a summary."""
+    values = [stats[f"latency_ms_p{p}"] for p in PERCENTILES]
+    if values[0] is None:
+        return f"No LLM calls ({stats['cached']} cached, {stats['skipped']} skipped)"
+    return (f"Latency p50/p95/p99: {'/'.join(f'{v:.0f}' for v in values)} ms over {stats['llm_calls']} LLM calls "
+            f"({stats['cached']} cached, {stats['skipped']} skipped)")
+
+
+def summary_path(output_path):
+    """The summary is written next to the extraction output: results/x/extraction.parquet -> extraction_telemetry.json."""
+    return os.path.splitext(output_path)[0] + "_telemetry.json"
+
+
+def write_summary(records, output_path):
+    stats = summary(records)
+    path = summary_path(output_path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+    return stats, path
@@ -0,0 +1,56 @@
+"""The grid of grid_config_stub.json through run_grid and latex_table, on synthetic reports."""
+
+import json
+import os
+
+import pytest
+
+from benchmark_grid import latex_table, run_grid
+from synthetic_reports import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def grid(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("grid")
+    reports = tmp / "reports.csv"
+    generate(60, seed=1, p_physiology=0.5).to_csv(reports, index=False)
+    with open(os.path.join(ROOT, "grid_config_stub.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    config.update(reports=str(reports), output_dir=str(tmp / "out"))
+    return config, run_grid(config)
+
+
+def test_run_grid_rows(grid):
+    config, results = grid
+    n_cells = len(config["sections"]) * len(config["models"]) * len(config["prompts"])
+    assert len(results) == 1 + n_cells
+    assert results.iloc[0]["label"] == "Baseline RegEx"
+    assert results["f1"].notna().all()
+    assert (results["reports_per_s"] > 0).all()
+    assert os.path.exists(os.path.join(config["output_dir"], "metrics.csv"))
+    assert len([f for f in os.listdir(config["output_dir"]) if f.endswith(".parquet")]) == n_cells
+
+    # The stub answers with the regex values, so its plain baseline cells score as the regex baseline
+    stub = results[(results["method"] == "baseline") & ~results["regex_confirmation"] & (results["prompt"] != "one_shot_absurd")]
+    assert (stub["f1"] == results.iloc[0]["f1"]).all()
+
+
+@pytest.mark.parametrize("timing_columns", [False, True])
+def test_latex_table(grid, timing_columns):
+    config, results = grid
+    lines = latex_table(results, timing_columns).splitlines()
+    n_cols = 6 + (3 if timing_columns else 0)
+
+    assert lines[0] == "\\begin{tabular}{l|llll|l" + ("|lll" if timing_columns else "") + "}"
+    assert lines[-2:] == ["\\bottomrule", "\\end{tabular}"]
+    body = [line for line in lines[2:-2] if line != "\\midrule"]
+    assert all(line.endswith(" \\\\") and len(line[:-3].split("&")) == n_cols for line in body)
+
+    # Header lines, one title line per run of sections with the same title, then a line per result
+    titles = [line.split(" &")[0] for line in body[2:] if line.split(" &")[0] in {s["title"] for s in config["sections"]}]
+    assert titles == ["Prompt Robustness - Hierarchical JSON Template (T2)", "Confirmation with RegEx", "Constrained Generation"]
+    rows = [line for line in body[2:] if line.split(" &")[0] not in titles]
+    assert [row.split(" & ")[0] for row in rows] == results["label"].tolist()
+    assert rows[0].split(" & ")[4] == f"{results.iloc[0]['f1']:.3f}"
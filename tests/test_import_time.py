@@ -0,0 +1,34 @@
+"""Import time of the extractor modules in a fresh interpreter, from python -X importtime."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmark_suite import IMPORT_MODULES, IMPORT_TIME_BUDGET_S
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """Cumulative import time in seconds of module and of each package it imports, with its nesting depth."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                         text=True, check=True, cwd=ROOT)
+    times = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(cumulative) / 1e6, depth)
+    return times
+
+
+@pytest.mark.parametrize("module", IMPORT_MODULES)
+def test_import_time(module):
+    times = import_times(module)
+    elapsed = times[module][0]
+    # The slowest imports of the module, to see what went over the budget
+    slowest = sorted((t, name) for name, (t, depth) in times.items() if depth == 1)[-5:]
+    assert elapsed <= IMPORT_TIME_BUDGET_S, f"import {module} took {elapsed:.2f}s, slowest imports: {slowest}"
@@ -0,0 +1,100 @@
+"""The concurrent Ollama client of extractor_baseline_llms against a fake Ollama server."""
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import extractor_baseline_llms as baseline
+
+TIMEOUT_S = 0.5
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    """Answers /api/generate and /api/chat with one NDJSON line. The report "R<n>" gets FFR n/100 in the
+    Coronária Direita and prompt_eval_count 100 + n; "TIMEOUT" answers after the client timeout, "ERROR" fails."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body.get("prompt") or body["messages"][-1]["content"]
+        if "ERROR" in prompt:
+            self.send_error(500)
+            return
+        # Answer in a random order, so the results do not come back in the order of the reports
+        time.sleep(TIMEOUT_S * 3 if "TIMEOUT" in prompt else random.uniform(0, 0.05))
+
+        n = int(re.search(r"R(\d+)", prompt).group(1))
+        answer = json.dumps({artery: {"FFR": n / 100 if artery == "Coronária Direita" else None, "iFR": None}
+                             for artery in baseline.ARTERIES}, ensure_ascii=False)
+        response = {"model": body["model"], "created_at": "2024-01-01T00:00:00Z", "done": True, "done_reason": "stop",
+                    "prompt_eval_count": 100 + n, "eval_count": 20, "prompt_eval_duration": 5_000_000,
+                    "eval_duration": 10_000_000, "total_duration": 15_000_000, "load_duration": 0}
+        if "messages" in body:
+            response["message"] = {"role": "assistant", "content": answer}
+        else:
+            response["response"] = answer
+        data = (json.dumps(response) + "\n").encode("utf-8")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass  # the client gave up (timeout)
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def reports():
+    texts = [f"R{n} FFR na CD." for n in range(12)]
+    texts[3] = "R3 TIMEOUT"
+    texts[7] = "R7 ERROR"
+    return pd.DataFrame({"id": [f"id{n}" for n in range(12)], "Conclusões": texts})
+
+
+@pytest.mark.parametrize("make", [baseline.make_llm, baseline.make_chat_llm])
+def test_answers_in_report_order_with_telemetry(base_url, make):
+    llm = make("fake", base_url, timeout=TIMEOUT_S)
+    df = reports()
+    results = baseline.extract_FFR_iFR_concurrent(df, llm, "zero_shot", max_in_flight=4, with_telemetry=True)
+
+    assert list(results.index) == list(df["id"])
+    for n, (answer, record) in enumerate(results):
+        if n in (3, 7):
+            # A timed out or failed request gives an answer of nulls and no telemetry
+            assert answer == "" and record is None
+            assert set(baseline.format_FFR_iFR(answer).values()) == {"NA"}
+            continue
+        assert json.loads(answer)["Coronária Direita"]["FFR"] == n / 100
+        assert record["prompt_tokens"] == 100 + n
+        assert record["generated_tokens"] == 20
+        assert record["prefill_ms"] == pytest.approx(5.0)
+        assert record["tokens_per_s"] == pytest.approx(2000.0)
+        assert not record["cached"]
+
+
+def test_answers_without_telemetry(base_url):
+    llm = baseline.make_llm("fake", base_url, timeout=TIMEOUT_S)
+    results = baseline.extract_FFR_iFR_concurrent(reports(), llm, "zero_shot", max_in_flight=4)
+
+    assert [record for _, record in results] == [None] * 12
+    answers = [answer for answer, _ in results]
+    assert answers[3] == answers[7] == ""
+    assert [json.loads(a)["Coronária Direita"]["FFR"] for n, a in enumerate(answers) if n not in (3, 7)] == \
+        [n / 100 for n in range(12) if n not in (3, 7)]
@@ -0,0 +1,75 @@
+"""Accuracy of the Ollama baseline with the pre-filter and the trimmed reports against the full reports, through
+a fake Ollama server that answers with the regex baseline values of the report it is sent (benchmark_grid.stub_answer).
+The stub only measures what the routing and the trimming take away from the model input, not how a real model
+reads a trimmed report."""
+
+import contextlib
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import extractor_baseline_llms as baseline
+from benchmark_grid import stub_answer
+from evaluation import evaluate_FFR_iFR
+from storage import read_table
+from synthetic_reports import generate
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests += 1
+        report = body["prompt"].rsplit("Relatório:\n    |", 1)[-1].rsplit("|", 1)[0]
+        response = {"model": body["model"], "created_at": "2024-01-01T00:00:00Z", "done": True, "done_reason": "stop",
+                    "response": stub_answer("baseline", report), "prompt_eval_count": len(body["prompt"]) // 4,
+                    "eval_count": 50}
+        data = (json.dumps(response) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(server, df_true, tmp_path, prefilter, trim):
+    llm = baseline.make_llm("stub", f"http://127.0.0.1:{server.server_address[1]}")
+    path = str(tmp_path / f"prefilter{int(prefilter)}_trim{int(trim)}.parquet")
+    server.requests = 0
+    # format_FFR_iFR prints every answer
+    with contextlib.redirect_stdout(io.StringIO()):
+        baseline.get_FFR_iFR(df_true[["id", "Conclusões"]].copy(), path, "zero_shot", llm, max_in_flight=4,
+                             prefilter=prefilter, trim=trim)
+    return evaluate_FFR_iFR(df_true, read_table(path), verbose=False), server.requests
+
+
+def test_prefilter_and_trim_keep_the_accuracy(server, tmp_path):
+    df_true = generate(300, seed=7)
+    full, full_requests = run(server, df_true, tmp_path, prefilter=False, trim=False)
+    routed, routed_requests = run(server, df_true, tmp_path, prefilter=True, trim=False)
+    assert full_requests == len(df_true)
+    assert routed_requests < full_requests / 2
+
+    # The routed reports have no value to find. The stub also reads values next to a vessel without any
+    # measure keyword, which the pre-filter routes to null, so precision can only go up
+    assert routed["recall"] == full["recall"]
+    assert routed["value_accuracy"] == full["value_accuracy"]
+    assert routed["precision"] >= full["precision"]
+
+    # The trimmed reports keep every sentence the values are read from
+    assert run(server, df_true, tmp_path, prefilter=False, trim=True)[0] == full
+    assert run(server, df_true, tmp_path, prefilter=True, trim=True)[0] == routed
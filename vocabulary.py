@@ -0,0 +1,65 @@
+"""Section headers, keywords, patterns and output columns of the CAG reports.
+
+Shared by the regex baseline, the pre-filter of the LLM extractors, the synthetic reports and the storage
+layer. The module only imports the standard library, so the LLM extractors can use the rules of the regex
+baseline without importing its script.
+"""
+
+import unicodedata
+
+
+def remove_accents(text):
+    if isinstance(text, str):
+        # Nothing to strip in plain ASCII, which is most of the text
+        if text.isascii():
+            return text
+        text = unicodedata.normalize('NFKD', text)
+        # Delete each distinct combining character at once instead of testing every character
+        for c in set(text):
+            if unicodedata.combining(c):
+                text = text.replace(c, '')
+    return text
+
+
+# Report sections
+top_separators =  ['CORONARIOGRAFIA','VENTRICULOGRAFIA','ANGIOPLASTIA',
+                       'CONCLUSAO','NOTA']
+
+# Define known vessel/region keywords and col names
+vessel_keywords = {'Descendente Anterior': ['Descendente Anterior'],
+    'Coronária Direita': ['Coronaria Direita', 'Descendente Posterior'],
+    'Tronco Comum': ['Tronco Comum'],
+    'Circunflexa': ['Circunflexa'],
+    'Outras_artérias': ['Marginal Obtusa','Ramo Intermedio', 'Bypass']}
+
+# FFR/iFR: numbers like 0.XX or 0,XX, physiological measure keywords, maximum word distance threshold and default measure
+ffr_ifr_num_pattern = r'\b0[.,]\d+\b'
+measure_keywords = ['iFR', 'FFR']
+MAX_WORD_DISTANCE = 40
+default_measure = 'iFR'
+
+# Stents
+stent_keywords = ['stent']
+STENT_MAX_WORD_DISTANCE = 20
+stent_default_measure = 'stent'
+
+# Output columns
+ffr_ifr_cols = ['Tronco_Comum_FFR', 'Descendente_Anterior_FFR', 'Circunflexa_FFR', 'Coronária_Direita_FFR', 'Outras_artérias_FFR',
+                'Tronco_Comum_iFR', 'Descendente_Anterior_iFR', 'Circunflexa_iFR', 'Coronária_Direita_iFR', 'Outras_artérias_iFR']
+
+# Stent lengths (text, several stents per artery) and the corresponding count columns
+stent_cols = [
+    'Comprimento_Stents_mm_Tronco_Comum',
+    'Comprimento_Stents_mm_Circunflexa',
+    'Comprimento_Stents_mm_Coronária_Direita',
+    'Comprimento_Stents_mm_Descendente_Anterior',
+    'Comprimento_Stents_mm_Outras_artérias'
+]
+
+count_cols = [
+    'Nr_Stents_Tronco_Comum',
+    'Nr_Stents_Circunflexa',
+    'Nr_Stents_Coronária_Direita',
+    'Nr_Stents_Descendente_Anterior',
+    'Nr_Stents_Outras_artérias'
+]
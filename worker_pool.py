@@ -0,0 +1,140 @@
+"""Pool of constrained extractor processes.
+
+Each worker is a separate process with its own llama.cpp context and few-shot prefix state, pulling reports
+from the task queue of the pool. llama.cpp memory-maps the GGUF file, so the weights are loaded once in the
+page cache and shared by all the workers; each one only adds its context (KV cache) and Python heap.
+The cores are split between the workers (LLAMA_N_THREADS), as the decode of one report does not use all of them.
+
+Run on its own to measure the throughput and memory of the pool for several numbers of workers:
+    python worker_pool.py --workers 1 2 4 --n 100
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+import pandas as pd
+import psutil
+
+extractor = None
+# Error of the worker initialisation, raised on its first report. Raising in the initializer itself would make
+# the pool start new workers forever
+init_error = None
+
+
+def threads_per_worker(workers):
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(barrier, settings):
+    global extractor, init_error
+    try:
+        import backbone_extractor_constrained_llms as extractor
+        # The thread count comes from LLAMA_N_THREADS, split between the workers
+        extractor.configure(**{k: v for k, v in settings.items() if k not in ("examples_path", "specialise_schema", "n_threads")})
+        if "examples_path" in settings:
+            extractor.set_examples(settings["examples_path"])
+        extractor.set_specialise(settings.get("specialise_schema", False))
+        extractor.build_lm(extractor.load_schema()[0])
+    except Exception as e:
+        init_error = f"Worker initialisation failed: {e!r}"
+    if barrier is not None:
+        barrier.wait()
+
+
+def _extract(task):
+    """(key, report) -> (key, extraction, telemetry); a failed extraction is None."""
+    key, report = task
+    if init_error:
+        raise RuntimeError(init_error)
+    try:
+        extracted, record = extractor.extract_timed(str(report))
+    except Exception:
+        extracted, record = None, None
+    return key, extracted, record
+
+
+class ExtractorPool:
+    """Constrained extraction over `workers` processes. Results come back as they are ready, not in order.
+    settings may set the examples_path and model settings of the workers (keyword arguments of the backbone
+    configure), otherwise they use the backbone defaults."""
+
+    def __init__(self, workers, settings=None, wait_ready=False):
+        self.workers = workers
+        # Read by the backbone when the workers import it, so they do not each start one thread per core
+        os.environ["LLAMA_N_THREADS"] = str(threads_per_worker(workers))
+        # Not fork: the parent may already hold a llama.cpp context and its threads
+        ctx = multiprocessing.get_context("spawn")
+        barrier = ctx.Barrier(workers + 1) if wait_ready else None
+        self.pool = ctx.Pool(workers, initializer=_init_worker, initargs=(barrier, settings or {}))
+        if barrier is not None:
+            barrier.wait()
+
+    def imap(self, tasks):
+        """Extract an iterable of (key, report), yielding (key, extraction, telemetry)."""
+        return self.pool.imap_unordered(_extract, tasks, chunksize=1)
+
+    def memory(self):
+        """Memory of the worker processes in MB. RSS counts the shared model pages in every worker, PSS splits them
+        between the processes that share them and USS is what each worker holds on its own."""
+        totals = {"rss_mb": 0.0, "pss_mb": 0.0, "uss_mb": 0.0}
+        for process in psutil.Process().children():
+            try:
+                info = process.memory_full_info()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            totals["rss_mb"] += info.rss / 2**20
+            totals["pss_mb"] += getattr(info, "pss", info.rss) / 2**20
+            totals["uss_mb"] += info.uss / 2**20
+        return totals
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """Stop the workers without extracting the reports they still have."""
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def measure(reports, workers, settings=None):
+    """Startup time, throughput and memory of a pool of `workers` processes on the reports."""
+    t0 = time.perf_counter()
+    with ExtractorPool(workers, settings, wait_ready=True) as pool:
+        startup = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        failed = sum(extracted is None for _, extracted, _ in pool.imap(enumerate(reports)))
+        elapsed = time.perf_counter() - t0
+        memory = pool.memory()
+    return {"workers": workers, "threads_per_worker": threads_per_worker(workers), "reports": len(reports),
+            "failed": failed, "startup_s": startup, "time_s": elapsed, "reports_per_s": len(reports) / elapsed,
+            **memory}
+
+
+#RUN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--n", type=int, default=100, help="number of reports")
+    parser.add_argument("--input", default="data/reports_groundtruth.csv")
+    parser.add_argument("--model", help="GGUF file (default: the model of the backbone)")
+    parser.add_argument("--output", default="results/worker_pool.csv")
+    args = parser.parse_args()
+
+    reports = pd.read_csv(args.input, usecols=["Conclusões"])["Conclusões"].head(args.n).tolist()
+    rows = []
+    for workers in args.workers:
+        rows.append(measure(reports, workers, {"model_path": args.model} if args.model else None))
+        r = rows[-1]
+        print(f"{workers} workers: {r['reports_per_s']:.2f} reports/s, startup {r['startup_s']:.1f}s, "
+              f"RSS {r['rss_mb']:.0f} MB, PSS {r['pss_mb']:.0f} MB, USS {r['uss_mb']:.0f} MB")
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    pd.DataFrame(rows).to_csv(args.output, index=False)
+    print(f"Results written to {args.output}")